@@ -0,0 +1,472 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import numpy as np
+from Mapa import Lane
+from Grafo import RoadGraph, DistanceFields
+
+MAP_FORMAT = 1  # Versión del formato de archivo de mapa y de su caché compilado
+
+class CityLayout:
+    """
+    Descripción estática de una ciudad: carriles, edificios, estacionamientos, semáforos,
+    glorietas y paradas de microbús. TrafficSimulation la recibe ya armada y solo coloca
+    los elementos, así el mismo modelo corre sobre el mapa original o sobre uno generado.
+    """
+
+    def __init__(self, width, height, lanes, buildings, parkings, lights, roundabouts=(), bus_stops=()):
+        self.width = width
+        self.height = height
+        self.lanes = list(lanes)
+        self.buildings = np.asarray(buildings, dtype=np.int32).reshape(-1, 2)  # Celdas de edificio empacadas
+        self.parkings = list(parkings)
+        self.lights = list(lights)
+        self.roundabouts = list(roundabouts)
+        self.bus_stops = list(bus_stops)
+
+        # Tablas precompiladas; las llena load_layout desde el caché en disco
+        self.road_graph = None
+        self.parking_fields = None
+        self.stop_fields = None
+
+
+def _flatten(groups):
+    return [pos for positions in groups for pos in positions]
+
+
+def default_layout(width=25, height=25):
+    """Mapa original de 25x25 de la actividad."""
+    # Las posiciones de nuestros carriles con sus direcciones
+    lanes = [
+        # --- CARRILES HORIZONTALES ---
+
+        # --- De derecha a izquierda ---
+        Lane([(x, height - 1) for x in range(24, 0, -1)], "right_to_left"),
+        Lane([(x, height - 2) for x in range(24, 0, -1)], "right_to_left"),
+        Lane([(x, height - 6) for x in range(13, 7, -1)], "right_to_left"),
+        Lane([(x, height - 7) for x in range(13, 7, -1)], "right_to_left"),
+        Lane([(x, height - 7) for x in range(23, 15, -1)], "right_to_left"),
+        Lane([(x, height - 8) for x in range(23, 15, -1)], "right_to_left"),
+        Lane([(x, height - 14) for x in range(13, 1, -1)], "right_to_left"),
+        Lane([(x, height - 13) for x in range(23, 1, -1)], "right_to_left"),
+        Lane([(x, height - 14) for x in range(23, 15, -1)], "right_to_left"),
+        Lane([(x, height - 19) for x in range(7, 1, -1)], "right_to_left"),
+        Lane([(x, height - 20) for x in range(7, 1, -1)], "right_to_left"),
+
+        # --- De izquierda a derecha ---
+        Lane([(x, height - 15) for x in range(2, 14)], "left_to_right"),
+        Lane([(x, height - 16) for x in range(2, 24)], "left_to_right"),
+        Lane([(x, height - 15) for x in range(16, 24)], "left_to_right"),
+        Lane([(x, height - 19) for x in range(8, 14)], "left_to_right"),
+        Lane([(x, height - 20) for x in range(8, 14)], "left_to_right"),
+        Lane([(x, height - 23) for x in range(1, 25)], "left_to_right"),
+        Lane([(x, height - 24) for x in range(1, 25)], "left_to_right"),
+
+
+        # --- CARRILES VERTICALES ---
+
+        # --- De arriba hacia abajo ---
+        Lane([(1, height - y) for y in range(1, 25)], "down"),
+        Lane([(2, height - y) for y in range(1, 25)], "down"),
+        Lane([(7, height - y) for y in range(16, 24)], "down"),
+        Lane([(8, height - y) for y in range(16, 24)], "down"),
+        Lane([(13, height - y) for y in range(2, 24)], "down"),
+        Lane([(14, height - y) for y in range(2, 14)], "down"),
+        Lane([(14, height - y) for y in range(16, 24)], "down"),
+
+        # --- De abajo hacia arriba ---
+        Lane([(7, height - y) for y in range(13, 1, -1)], "up"),
+        Lane([(8, height - y) for y in range(13, 1, -1)], "up"),
+        Lane([(15, height - y) for y in range(13, 1, -1)], "up"),
+        Lane([(15, height - y) for y in range(23, 15, -1)], "up"),
+        Lane([(16, height - y) for y in range(23, 1, -1)], "up"),
+        Lane([(19, height - y) for y in range(23, 15, -1)], "up"),
+        Lane([(20, height - y) for y in range(23, 15, -1)], "up"),
+        Lane([(23, height - y) for y in range(24, 0, -1)], "up"),
+        Lane([(24, height - y) for y in range(24, 0, -1)], "up"),
+
+        # --- CAMINOS PARA METERSE A LOS ESTACIONAMIENTOS ---
+        Lane([(x, height - 10) for x in range(2, 4)], "left_to_right"), # Para meterse al 1
+        Lane([(4, height - y) for y in range(2, 4)], "down"), # Para meterse al 2
+        Lane([(4, height - y) for y in range(19, 17, -1)], "up"), # Para meterse al 3
+        Lane([(5, height - y) for y in range(13, 11, -1)], "up"), # Para meterse al 4
+        Lane([(5, height - y) for y in range(20, 22)], "down"), # Para meterse al 5
+        Lane([(x, height - 7) for x in range(7, 5, -1)], "right_to_left"), # Para meterse al 6
+        Lane([(x, height - 9) for x in range(8, 10)], "left_to_right"), # Para meterse al 7
+        Lane([(10, height - y) for y in range(23, 21, -1)], "up"), # Para meterse al 8
+        Lane([(11, height - y) for y in range(6, 4, -1)], "up"), # Para meterse al 9
+        Lane([(11, height - y) for y in range(13, 11, -1)], "up"), # Para meterse al 10
+        Lane([(11, height - y) for y in range(16, 18)], "down"), # Para meterse al 11
+        Lane([(18, height - y) for y in range(2, 4)], "down"), # Para meterse al 12
+        Lane([(x, height - 18) for x in range(19, 17, -1)], "right_to_left"), # Para meterse al 13
+        Lane([(x, height - 20) for x in range(19, 17, -1)], "right_to_left"), # Para meterse al 14
+        Lane([(21, height - y) for y in range(7, 5, -1)], "up"), # Para meterse al 15
+        Lane([(21, height - y) for y in range(8, 10)], "down"), # Para meterse al 16
+        Lane([(x, height - 20) for x in range(20, 22)], "left_to_right"), # Para meterse al 17
+
+    ]
+
+    # Paradas de recolección de pasajeros de los microbuses
+    bus_stops = [
+        (21, 16), (22, 2), (21, 23), (22, 8),
+        (12, 23), (12, 19), (2, 3), (3, 13), (9, 13), (7, 12)
+    ]
+
+    # Coordenadas específicas para los edificios
+    building_positions = [
+        # --- PRIMER CUADRANTE ---
+
+        # ---- Primer edificio ---
+        [(3, height - y) for y in range(3, 10)],  # Edificios en la columna 3 desde la fila 3 a la 9
+        [(3, height - y) for y in range(11, 13)],  # Edificios en la columna 3 desde la fila 11 a la 12
+        [(4, height - y) for y in range(4, 13)],  # Edificios en la columna 4 desde la fila 4 a la 12
+        [(5, height - y) for y in range(3, 12)],   # Edificios en la columna 5 desde la fila 3 a la 11
+        [(6, height - y) for y in range(3, 7)],   # Edificios en la columna 6 desde la fila 3 a la 6
+        [(6, height - y) for y in range(8, 13)],   # Edificios en la columna 6 desde la fila 8 a la 13
+
+        # ---- Segundo edificio ---
+        [(9, height - y) for y in range(3, 6)],  # Edificios en la columna 9 desde la fila 3 a la 5
+        [(9, height - y) for y in range(8, 9)],  # Edificios en la columna 9 desde la fila 8 a la 8
+        [(9, height - y) for y in range(10, 13)],  # Edificios en la columna 9 desde la fila 10 a la 12
+        [(10, height - y) for y in range(3, 6)],  # Edificios en la columna 10 desde la fila 3 a la 5
+        [(10, height - y) for y in range(8, 13)],  # Edificios en la columna 10 desde la fila 8 a la 12
+        [(11, height - y) for y in range(3, 5)],  # Edificios en la columna 11 desde la fila 3 a la 4
+        [(11, height - y) for y in range(8, 12)],  # Edificios en la columna 11 desde la fila 8 a la 11
+        [(12, height - y) for y in range(3, 6)],  # Edificios en la columna 12 desde la fila 3 a la 5
+        [(12, height - y) for y in range(8, 13)],  # Edificios en la columna 12 desde la fila 8 a la 12
+
+
+        # --- SEGUNDO CUADRANTE ---
+        [(17, height - y) for y in range(3, 7)],  # Edificios en la columna 17 desde la fila 3 a la 6
+        [(17, height - y) for y in range(9, 13)],  # Edificios en la columna 17 desde la fila 9 a la 12
+        [(18, height - y) for y in range(4, 7)],  # Edificios en la columna 18 desde la fila 4 a la 6
+        [(18, height - y) for y in range(9, 13)],  # Edificios en la columna 18 desde la fila 9 a la 12
+        [(19, height - y) for y in range(3, 7)],  # Edificios en la columna 19 desde la fila 3 a la 6
+        [(19, height - y) for y in range(9, 13)],  # Edificios en la columna 19 desde la fila 9 a la 12
+        [(20, height - y) for y in range(3, 7)],  # Edificios en la columna 20 desde la fila 3 a la 6
+        [(20, height - y) for y in range(9, 13)],  # Edificios en la columna 20 desde la fila 9 a la 12
+        [(21, height - y) for y in range(3, 6)],  # Edificios en la columna 21 desde la fila 3 a la 5
+        [(21, height - y) for y in range(10, 13)],  # Edificios en la columna 21 desde la fila 10 a la 12
+        [(22, height - y) for y in range(3, 7)],  # Edificios en la columna 22 desde la fila 3 a la 6
+        [(22, height - y) for y in range(9, 13)],  # Edificios en la columna 22 desde la fila 9 a la 12
+
+
+        # --- TERCER CUADRANTE ---
+
+        # ---- Primer edificio ---
+        [(3, height - y) for y in range(17, 19)],  # Edificios en la columna 3 desde la fila 17 a la 18
+        [(3, height - y) for y in range(21, 23)],  # Edificios en la columna 3 desde la fila 21 a la 22
+        [(4, height - y) for y in range(17, 18)],  # Edificios en la columna 4 desde la fila 17 a la 17
+        [(4, height - y) for y in range(21, 23)],  # Edificios en la columna 4 desde la fila 21 a la 22
+        [(5, height - y) for y in range(17, 19)],  # Edificios en la columna 5 desde la fila 17 a la 18
+        [(5, height - y) for y in range(22, 23)],  # Edificios en la columna 5 desde la fila 22 a la 22
+        [(6, height - y) for y in range(17, 19)],  # Edificios en la columna 6 desde la fila 17 a la 18
+        [(6, height - y) for y in range(21, 23)],  # Edificios en la columna 6 desde la fila 21 a la 22
+
+        # ---- Segundo edificio ---
+        [(9, height - y) for y in range(17, 19)],  # Edificios en la columna 9 desde la fila 17 a la 18
+        [(9, height - y) for y in range(21, 23)],  # Edificios en la columna 9 desde la fila 21 a la 22
+        [(10, height - y) for y in range(17, 19)],  # Edificios en la columna 10 desde la fila 17 a la 18
+        [(10, height - y) for y in range(21, 22)],  # Edificios en la columna 10 desde la fila 21 a la 21
+        [(11, height - y) for y in range(18, 19)],  # Edificios en la columna 11 desde la fila 18 a la 18
+        [(11, height - y) for y in range(21, 23)],  # Edificios en la columna 11 desde la fila 21 a la 22
+        [(12, height - y) for y in range(17, 19)],  # Edificios en la columna 12 desde la fila 17 a la 18
+        [(12, height - y) for y in range(21, 23)],  # Edificios en la columna 12 desde la fila 21 a la 22
+
+
+        # --- CUARTO CUADRANTE ---
+
+        # ---- Primer edificio ---
+        [(17, height - y) for y in range(17, 23)],  # Edificios en la columna 17 desde la fila 17 a la 22
+        [(17, height - y) for y in range(17, 23)],  # Edificios en la columna 17 desde la fila 17 a la 22
+        [(18, height - y) for y in range(17, 18)],  # Edificios en la columna 18 desde la fila 17 a la 17
+        [(18, height - y) for y in range(19, 20)],  # Edificios en la columna 18 desde la fila 19 a la 19
+        [(18, height - y) for y in range(21, 23)],  # Edificios en la columna 18 desde la fila 21 a la 22
+        [(21, height - y) for y in range(17, 20)],  # Edificios en la columna 21 desde la fila 17 a la 19
+        [(21, height - y) for y in range(21, 23)],  # Edificios en la columna 21 desde la fila 21 a la 22
+        [(22, height - y) for y in range(17, 23)],  # Edificios en la columna 22 desde la fila 17 a la 22
+    ]
+
+    # Coordenadas específicas para los estacionamientos
+    parking_positions = [
+        [(3,height - 10)],
+        [(4,height - 3)],
+        [(5,height - 12)],
+        [(6,height - 7)],
+        [(9,height - 9)],
+        [(11,height - 5)],
+        [(11,height - 12)],
+        [(4,height - 18)],
+        [(5,height - 21)],
+        [(10,height - 22)],
+        [(11,height - 17)],
+        [(18,height - 3)],
+        [(21,height - 6)],
+        [(21,height - 9)],
+        [(18,height - 18)],
+        [(18,height - 20)],
+        [(21,height - 20)],
+    ]
+
+    # Coordenadas específicas para los semaforos
+    lights_positions = [
+        # --- Semaforos horizontales ---
+        [(x, height - 18) for x in range(1, 3)],
+        [(x, height - 3) for x in range(7, 9)],
+        [(x, height - 8) for x in range(7, 9)],
+        [(x, height - 22) for x in range(7, 9)],
+        [(x, height - 17) for x in range(19, 21)],
+
+        # --- Semaforos verticales ---
+        [(3, height - y) for y in range(19, 21)],
+        [(6, height - y) for y in range(23, 25)],
+        [(9, height - y) for y in range(1, 3)],
+        [(9, height - y) for y in range(6, 8)],
+        [(18, height - y) for y in range(15, 17)],
+    ]
+
+    # Coordenadas específicas para la glorieta
+    roundabouts_positions = [
+        [(14, height - y) for y in range(14, 16)],
+        [(15, height - y) for y in range(14, 16)],
+    ]
+
+    return CityLayout(
+        width, height, lanes,
+        buildings=_flatten(building_positions),
+        parkings=_flatten(parking_positions),
+        lights=_flatten(lights_positions),
+        roundabouts=_flatten(roundabouts_positions),
+        bus_stops=bus_stops,
+    )
+
+
+def generate_city(width, height, block_size=4, parking_rate=0.5, light_rate=0.5, num_bus_stops=10, seed=None):
+    """
+    Genera una ciudad en cuadrícula para cualquier tamaño de grid.
+
+    Las calles son de doble sentido (dos carriles, uno por dirección) y se cruzan cada
+    block_size + 2 celdas. Las manzanas se llenan de edificios; algunas tienen un
+    estacionamiento con su carril de entrada desde la calle de la izquierda y algunos
+    cruces tienen semáforos en la calle vertical, justo antes de la intersección.
+
+    Args:
+        width (int): Ancho del grid.
+        height (int): Alto del grid.
+        block_size (int): Lado de cada manzana, en celdas.
+        parking_rate (float): Probabilidad de que una manzana tenga estacionamiento.
+        light_rate (float): Probabilidad de que un cruce tenga semáforos.
+        num_bus_stops (int): Número de paradas de microbús, elegidas sobre las calles.
+        seed: Semilla del generador, para repetir el mismo mapa.
+
+    Returns:
+        CityLayout: La ciudad generada.
+    """
+    rng = random.Random(seed)
+    pitch = block_size + 2
+    road_xs = list(range(1, width - 1, pitch))  # Cada calle ocupa las columnas x y x + 1
+    road_ys = list(range(1, height - 1, pitch))
+    if block_size < 1 or len(road_xs) < 2 or len(road_ys) < 2:
+        raise ValueError(f"Un grid de {width}x{height} no alcanza para manzanas de {block_size} celdas.")
+
+    x_lo, x_hi = road_xs[0], road_xs[-1] + 1
+    y_lo, y_hi = road_ys[0], road_ys[-1] + 1
+
+    xs = np.arange(x_lo, x_hi + 1)
+    ys = np.arange(y_lo, y_hi + 1)
+    lanes = []
+    for y in road_ys:
+        lanes.append(Lane(np.column_stack([xs, np.full_like(xs, y)]), "left_to_right"))
+        lanes.append(Lane(np.column_stack([xs[::-1], np.full_like(xs, y + 1)]), "right_to_left"))
+    for x in road_xs:
+        lanes.append(Lane(np.column_stack([np.full_like(ys, x), ys[::-1]]), "down"))
+        lanes.append(Lane(np.column_stack([np.full_like(ys, x + 1), ys]), "up"))
+    road_mask = np.zeros((width, height), dtype=bool)
+    for y in road_ys:
+        road_mask[x_lo:x_hi + 1, y:y + 2] = True
+    for x in road_xs:
+        road_mask[x:x + 2, y_lo:y_hi + 1] = True
+    road_cells = np.argwhere(road_mask)  # Ordenadas por coordenada
+
+    # Las manzanas se marcan en una máscara y los edificios salen de ella de una sola vez
+    block_mask = np.zeros((width, height), dtype=bool)
+    parkings = []
+    for y0, y1 in zip(road_ys, road_ys[1:]):
+        for x0, x1 in zip(road_xs, road_xs[1:]):
+            block_mask[x0 + 2:x1, y0 + 2:y1] = True
+            if rng.random() < parking_rate:
+                parking = (x0 + 2, (y0 + 2 + y1 - 1) // 2)
+                parkings.append(parking)
+                block_mask[parking] = False
+                # Carril de entrada desde la calle de la izquierda
+                lanes.append(Lane([(parking[0] - 1, parking[1]), parking], "left_to_right"))
+    buildings = np.argwhere(block_mask)
+
+    lights = []
+    for y in road_ys[1:]:
+        for x in road_xs:
+            if rng.random() < light_rate:
+                lights.extend([(x, y - 1), (x + 1, y - 1)])
+
+    bus_stops = [tuple(road_cells[i].tolist()) for i in rng.sample(range(len(road_cells)), min(num_bus_stops, len(road_cells)))]
+
+    return CityLayout(width, height, lanes, buildings, parkings, lights, bus_stops=bus_stops)
+
+
+def _pack(positions):
+    """Aplana [(x, y), ...] o un arreglo (K, 2) a [x0, y0, x1, y1, ...] para el archivo de mapa."""
+    return np.asarray(positions, dtype=np.int64).reshape(-1).tolist()
+
+
+def _unpack(coords):
+    return [(coords[i], coords[i + 1]) for i in range(0, len(coords), 2)]
+
+
+def save_layout(layout, path):
+    """
+    Guarda la ciudad en un archivo JSON compacto: cada lista de posiciones va aplanada
+    como [x0, y0, x1, y1, ...] y cada carril como su dirección más sus celdas.
+    """
+    data = {
+        "format": MAP_FORMAT,
+        "width": layout.width,
+        "height": layout.height,
+        "lanes": [{"direction": lane.direction, "cells": _pack(lane.positions)} for lane in layout.lanes],
+        "buildings": _pack(layout.buildings),
+        "parkings": _pack(layout.parkings),
+        "lights": _pack(layout.lights),
+        "roundabouts": _pack(layout.roundabouts),
+        "bus_stops": _pack(layout.bus_stops),
+    }
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(data, file, separators=(",", ":"))
+
+
+def load_layout(path, use_cache=True):
+    """
+    Carga una ciudad guardada con save_layout.
+
+    Con use_cache, el grafo de carriles y las tablas de distancia hacia estacionamientos y
+    paradas se leen de la carpeta <path>.cache como arreglos NumPy mapeados a memoria. Si el
+    caché no existe o no corresponde al contenido del mapa, se compilan y se escriben ahí,
+    así el siguiente arranque ya no los recalcula. Las tablas de distancia solo se guardan
+    cuando caben como tablas densas; en mapas grandes quedan en None y el modelo las resuelve.
+
+    Returns:
+        CityLayout: La ciudad, con road_graph, parking_fields y stop_fields si se usó el caché.
+    """
+    with open(path, "rb") as file:
+        raw = file.read()
+    data = json.loads(raw)
+    if data.get("format") != MAP_FORMAT:
+        raise ValueError(f"Formato de mapa no soportado en {path}: {data.get('format')}")
+
+    layout = CityLayout(
+        data["width"], data["height"],
+        [Lane(np.reshape(lane["cells"], (-1, 2)), lane["direction"]) for lane in data["lanes"]],
+        buildings=np.reshape(data["buildings"], (-1, 2)),
+        parkings=_unpack(data["parkings"]),
+        lights=_unpack(data["lights"]),
+        roundabouts=_unpack(data["roundabouts"]),
+        bus_stops=_unpack(data["bus_stops"]),
+    )
+    if use_cache:
+        key = f"{MAP_FORMAT}:{hashlib.sha256(raw).hexdigest()}"
+        cache_dir = path + ".cache"
+        if not _load_compiled(layout, cache_dir, key):
+            _save_compiled(layout, cache_dir, key)
+    return layout
+
+
+def _load_compiled(layout, cache_dir, key):
+    """Lee las tablas compiladas si el caché corresponde a este mapa."""
+    try:
+        with open(os.path.join(cache_dir, "key.txt"), encoding="utf-8") as file:
+            if file.read() != key:
+                return False
+        positions = np.load(os.path.join(cache_dir, "graph_positions.npy"), mmap_mode="r")
+        edges = np.load(os.path.join(cache_dir, "graph_edges.npy"), mmap_mode="r")
+        graph = RoadGraph.from_arrays(positions, edges)
+        parking_fields = _load_fields(graph, cache_dir, "parking")
+        stop_fields = _load_fields(graph, cache_dir, "stop")
+    except (OSError, ValueError):
+        return False
+
+    layout.road_graph = graph
+    layout.parking_fields = parking_fields
+    layout.stop_fields = stop_fields
+    return True
+
+
+def _load_fields(graph, cache_dir, prefix):
+    """Lee las tablas densas de <prefix>; si el caché no las trae (mapa grande), devuelve None."""
+    paths = [os.path.join(cache_dir, f"{prefix}_{name}.npy") for name in ("targets", "distances", "next_hops")]
+    if not os.path.exists(paths[0]):
+        return None
+    targets, distances, next_hops = (np.load(path, mmap_mode="r") for path in paths)
+    return DistanceFields.from_arrays(graph, targets, distances, next_hops)
+
+
+def _save_compiled(layout, cache_dir, key):
+    """
+    Compila el grafo y las tablas del mapa y los escribe en la carpeta de caché.
+
+    Las tablas de distancia solo se guardan si quedaron densas (dentro de
+    DistanceFields.DENSE_LIMIT); en mapas grandes el caché lleva solo el grafo y el modelo
+    arma sus campos dispersos al vuelo, así el caché nunca crece como destinos x nodos.
+    """
+    graph = RoadGraph(layout.lanes)
+    layout.road_graph = graph
+
+    positions, edges = graph.to_arrays()
+    arrays = {"graph_positions": positions, "graph_edges": edges}
+    layout.parking_fields = _dense_fields(graph, layout.parkings, arrays, "parking")
+    layout.stop_fields = _dense_fields(graph, layout.bus_stops, arrays, "stop")
+
+    # Se escribe en una carpeta temporal que luego reemplaza a la anterior de un solo golpe:
+    # un caché a medio escribir nunca queda junto a una llave válida, y los procesos que
+    # tienen mapeados los archivos viejos los conservan intactos
+    parent = os.path.dirname(os.path.abspath(cache_dir))
+    staging = tempfile.mkdtemp(prefix=os.path.basename(cache_dir) + ".", dir=parent)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(staging, name + ".npy"), array)
+        with open(os.path.join(staging, "key.txt"), "w", encoding="utf-8") as file:
+            file.write(key)
+        _swap_dir(staging, cache_dir)
+    finally:
+        if os.path.isdir(staging):
+            shutil.rmtree(staging, ignore_errors=True)
+
+
+def _dense_fields(graph, targets, arrays, prefix):
+    """Calcula los campos hacia targets y, si quedaron densos, agrega sus tablas a arrays."""
+    fields = DistanceFields(graph, targets)
+    if not fields.dense:
+        return None  # El modelo los arma dispersos, compartiendo su grafo de tramos
+    arrays[prefix + "_targets"] = np.array(fields.targets, dtype=np.int32).reshape(-1, 2)
+    arrays[prefix + "_distances"] = fields.distances
+    arrays[prefix + "_next_hops"] = fields.next_hops
+    return fields
+
+
+def _swap_dir(staging, cache_dir):
+    """Pone staging en lugar de cache_dir; si otro proceso ganó la carrera, conserva el suyo."""
+    retired = None
+    if os.path.exists(cache_dir):
+        retired = tempfile.mkdtemp(prefix=os.path.basename(cache_dir) + ".old.", dir=os.path.dirname(staging))
+        try:
+            os.replace(cache_dir, retired)
+        except OSError:
+            os.rmdir(retired)
+            return
+    try:
+        os.replace(staging, cache_dir)
+    except OSError:
+        pass  # Otro proceso ya instaló un caché en ese lugar
+    finally:
+        if retired is not None:
+            shutil.rmtree(retired, ignore_errors=True)
@@ -1,3 +1,4 @@
+import numpy as np
 from mesa import Model
 from mesa.space import MultiGrid
 from mesa.time import SimultaneousActivation
@@ -9,10 +10,14 @@ from Jeep import Jeeps
 from Toyota import Toyota
 
 from Semaforo import TrafficLight
-from Mapa import Building, Parking, Roundabout, Lane
+from Mapa import Parking, Roundabout
+from Mapa import CELL_EMPTY, CELL_BUILDING, CELL_PARKING, CELL_LIGHT, CELL_ROUNDABOUT
+from Grafo import RoadGraph, SegmentGraph, DistanceFields, RouteCache, StopRegistry, ObstacleLog
+from Negotiation import Negotiation
+from Ciudad import default_layout
 
 class TrafficSimulation(Model):
-    def __init__(self, width, height, num_vehicles, num_microbus, num_moto, num_jeeps, num_toyota):
+    def __init__(self, width, height, num_vehicles, num_microbus, num_moto, num_jeeps, num_toyota, route_cache_size=256, layout=None):
         super().__init__()
         self.width = width
         self.height = height
@@ -21,287 +26,411 @@ class TrafficSimulation(Model):
         self.grid = MultiGrid(width, height, torus=False)
         self.schedule = SimultaneousActivation(self)
 
+        # Mapa de la ciudad: el original de 25x25 si no se da otro (ver Ciudad.py)
+        self.layout = layout if layout is not None else default_layout(width, height)
+        if (self.layout.width, self.layout.height) != (width, height):
+            raise ValueError(
+                f"El mapa mide {self.layout.width}x{self.layout.height} y el grid {width}x{height}"
+            )
+
         # Las posiciones de nuestros carriles con sus direcciones
-        self.lanes_positions = [
-            # --- CARRILES HORIZONTALES ---
-
-            # --- De derecha a izquierda ---
-            Lane([(x, height - 1) for x in range(24, 0, -1)], "right_to_left"),
-            Lane([(x, height - 2) for x in range(24, 0, -1)], "right_to_left"),
-            Lane([(x, height - 6) for x in range(13, 7, -1)], "right_to_left"),
-            Lane([(x, height - 7) for x in range(13, 7, -1)], "right_to_left"),
-            Lane([(x, height - 7) for x in range(23, 15, -1)], "right_to_left"),
-            Lane([(x, height - 8) for x in range(23, 15, -1)], "right_to_left"),
-            Lane([(x, height - 14) for x in range(13, 1, -1)], "right_to_left"),
-            Lane([(x, height - 13) for x in range(23, 1, -1)], "right_to_left"),
-            Lane([(x, height - 14) for x in range(23, 15, -1)], "right_to_left"),
-            Lane([(x, height - 19) for x in range(7, 1, -1)], "right_to_left"),
-            Lane([(x, height - 20) for x in range(7, 1, -1)], "right_to_left"),
-
-            # --- De izquierda a derecha ---
-            Lane([(x, height - 15) for x in range(2, 14)], "left_to_right"),
-            Lane([(x, height - 16) for x in range(2, 24)], "left_to_right"),
-            Lane([(x, height - 15) for x in range(16, 24)], "left_to_right"),
-            Lane([(x, height - 19) for x in range(8, 14)], "left_to_right"),
-            Lane([(x, height - 20) for x in range(8, 14)], "left_to_right"),
-            Lane([(x, height - 23) for x in range(1, 25)], "left_to_right"),
-            Lane([(x, height - 24) for x in range(1, 25)], "left_to_right"),
-
-
-            # --- CARRILES VERTICALES ---
-
-            # --- De arriba hacia abajo ---
-            Lane([(1, height - y) for y in range(1, 25)], "down"),
-            Lane([(2, height - y) for y in range(1, 25)], "down"),
-            Lane([(7, height - y) for y in range(16, 24)], "down"),
-            Lane([(8, height - y) for y in range(16, 24)], "down"),
-            Lane([(13, height - y) for y in range(2, 24)], "down"),
-            Lane([(14, height - y) for y in range(2, 14)], "down"),
-            Lane([(14, height - y) for y in range(16, 24)], "down"),
-
-            # --- De abajo hacia arriba ---
-            Lane([(7, height - y) for y in range(13, 1, -1)], "up"),
-            Lane([(8, height - y) for y in range(13, 1, -1)], "up"),
-            Lane([(15, height - y) for y in range(13, 1, -1)], "up"),
-            Lane([(15, height - y) for y in range(23, 15, -1)], "up"),
-            Lane([(16, height - y) for y in range(23, 1, -1)], "up"),
-            Lane([(19, height - y) for y in range(23, 15, -1)], "up"),
-            Lane([(20, height - y) for y in range(23, 15, -1)], "up"),
-            Lane([(23, height - y) for y in range(24, 0, -1)], "up"),
-            Lane([(24, height - y) for y in range(24, 0, -1)], "up"),
-
-            # --- CAMINOS PARA METERSE A LOS ESTACIONAMIENTOS ---
-            Lane([(x, height - 10) for x in range(2, 4)], "left_to_right"), # Para meterse al 1
-            Lane([(4, height - y) for y in range(2, 4)], "down"), # Para meterse al 2
-            Lane([(4, height - y) for y in range(19, 17, -1)], "up"), # Para meterse al 3
-            Lane([(5, height - y) for y in range(13, 11, -1)], "up"), # Para meterse al 4
-            Lane([(5, height - y) for y in range(20, 22)], "down"), # Para meterse al 5
-            Lane([(x, height - 7) for x in range(7, 5, -1)], "right_to_left"), # Para meterse al 6
-            Lane([(x, height - 9) for x in range(8, 10)], "left_to_right"), # Para meterse al 7
-            Lane([(10, height - y) for y in range(23, 21, -1)], "up"), # Para meterse al 8
-            Lane([(11, height - y) for y in range(6, 4, -1)], "up"), # Para meterse al 9
-            Lane([(11, height - y) for y in range(13, 11, -1)], "up"), # Para meterse al 10
-            Lane([(11, height - y) for y in range(16, 18)], "down"), # Para meterse al 11
-            Lane([(18, height - y) for y in range(2, 4)], "down"), # Para meterse al 12
-            Lane([(x, height - 18) for x in range(19, 17, -1)], "right_to_left"), # Para meterse al 13
-            Lane([(x, height - 20) for x in range(19, 17, -1)], "right_to_left"), # Para meterse al 14
-            Lane([(21, height - y) for y in range(7, 5, -1)], "up"), # Para meterse al 15
-            Lane([(21, height - y) for y in range(8, 10)], "down"), # Para meterse al 16
-            Lane([(x, height - 20) for x in range(20, 22)], "left_to_right"), # Para meterse al 17
+        self.lanes_positions = self.layout.lanes
 
-        ]
+        # Paradas de recolección de pasajeros de los microbuses
+        self.bus_stops = self.layout.bus_stops
+
+        # Compilamos una sola vez el grafo de carriles que consultan todos los vehículos,
+        # o lo tomamos del caché del mapa si la ciudad se cargó de archivo
+        self.road_graph = self.layout.road_graph or RoadGraph(self.lanes_positions)
+        self._lanes_cache = None  # Se arma la primera vez que se piden los carriles
 
         # Elementos del entorno
+        self.parkings = {}  # Posición -> Parking
+        self.free_parkings = set()  # Índice de estacionamientos libres, lo mantiene Parking
+        self.parking_version = 0  # Cambia cada vez que se ocupa o libera un estacionamiento
+        self.obstacles = np.zeros((width, height), dtype=bool)  # Edificios y vehículos estacionados
+        self.obstacle_version = 0  # Cambia con cada actualización de la máscara de obstáculos
+        self.obstacle_log = ObstacleLog()  # Celdas cuyo estado cambió; la consumen los planificadores incrementales
+        self.route_cache = RouteCache(route_cache_size)  # Rutas compartidas entre vehículos
+        self.cell_types = np.full((width, height), CELL_EMPTY, dtype=np.int8)  # Capa estática del mapa
+        self.vehicle_counts = np.zeros((width, height), dtype=np.int16)  # Vehículos por celda
+        self.static_elements = {}  # Posición -> estacionamiento o glorieta; los edificios solo viven en cell_types
+        self.vehicles = {}  # Clase -> vehículos de esa clase, en orden de creación
+        self.lights = []  # Semáforos
+        self.moving_vehicles = {}  # Hash espacial: posición -> vehículos sin estacionar en esa celda
+        self.negotiations = {}  # Vehículo -> [(otro, acción propia, acción del otro)] del paso actual
+        self._spawn_pool = None  # Celdas de carril libres, barajadas, para colocar vehículos
         self._place_static_elements()
+
+        # Semáforos a distancia <= 2 de cada celda; los semáforos no se mueven, así que
+        # la tabla de zonas se arma una sola vez, al construir el mapa
+        self._build_light_zones()
+
+        # Tablas de distancia y siguiente salto hacia cada estacionamiento
+        # Se calculan la primera vez que un vehículo las consulta; en mapas grandes
+        # construir el modelo no paga por ellas
+        self._route_tables = None
         
         # Creamos nuestros agentes de vehículo del Ferrari
         for i in range(num_vehicles):
             vehicle = Vehicle(self.next_id(), self)
-            self.schedule.add(vehicle)
             x, y = self.random_empty_position()
-            self.grid.place_agent(vehicle, (x, y))
+            self.add_vehicle(vehicle, (x, y))
 
         for i in range(num_microbus):
             microbus = Microbus(self.next_id(), self)
-            self.schedule.add(microbus)
             x, y = self.random_empty_position()
-            self.grid.place_agent(microbus, (x, y))
+            self.add_vehicle(microbus, (x, y))
 
         for i in range(num_moto):
             moto = Moto(self.next_id(), self)
-            self.schedule.add(moto)
             x, y = self.random_empty_position()
-            self.grid.place_agent(moto, (x, y))
+            self.add_vehicle(moto, (x, y))
 
         for i in range(num_jeeps):
             jeep = Jeeps(self.next_id(), self)
-            self.schedule.add(jeep)
             x, y = self.random_empty_position()
-            self.grid.place_agent(jeep, (x, y))
+            self.add_vehicle(jeep, (x, y))
 
         for i in range(num_toyota):
             toyota = Toyota(self.next_id(), self)
-            self.schedule.add(toyota)
             x, y = self.random_empty_position()
-            self.grid.place_agent(toyota, (x, y))
+            self.add_vehicle(toyota, (x, y))
         
+        # Estrategias de negociación; se siembra desde el generador del modelo
+        self.negotiation_rng = np.random.default_rng(self.random.getrandbits(64))
+
         self.running = True
         self.datacollector = DataCollector(agent_reporters={"Happiness": "happiness"})
 
     def get_lanes_positions(self):
         """Devuelve las posiciones de los carriles"""
-        return [(lane.positions, lane.direction) for lane in self.lanes_positions]
+        if self._lanes_cache is None:
+            self._lanes_cache = [
+                ([tuple(pos) for pos in lane.positions.tolist()], lane.direction) for lane in self.lanes_positions
+            ]
+        return self._lanes_cache
+
+    def _build_route_tables(self):
+        """
+        Precalcula el grafo de tramos, los campos de distancia inversos de cada estacionamiento
+        y la matriz de distancias entre paradas de microbús. En mapas grandes los campos no
+        arman tablas densas y responden con búsquedas sobre el grafo de tramos.
+
+        Estacionamientos y paradas son fijos, así que solo hay que llamarlo de nuevo si cambia el mapa.
+        """
+        segments = SegmentGraph(self.road_graph, self.parkings)
+        self._route_tables = (
+            segments,
+            self._layout_fields(self.layout.parking_fields, self.parkings, segments),
+            StopRegistry(self.road_graph, self.bus_stops, self._layout_fields(self.layout.stop_fields, self.bus_stops)),
+        )
+        self.route_cache.clear()
+        return self._route_tables
+
+    @property
+    def segment_graph(self):
+        return (self._route_tables or self._build_route_tables())[0]
+
+    @property
+    def parking_fields(self):
+        return (self._route_tables or self._build_route_tables())[1]
+
+    @property
+    def stop_registry(self):
+        return (self._route_tables or self._build_route_tables())[2]
+
+    def _layout_fields(self, fields, targets, segments=None):
+        """Usa las tablas del caché del mapa si son de este grafo y estos destinos; si no, las calcula."""
+        if fields is not None and fields.graph is self.road_graph and fields.targets == tuple(sorted(set(targets))):
+            return fields
+        return DistanceFields(self.road_graph, targets, segments)
 
     def _place_static_elements(self):
-        height = self.height
-        # Coordenadas específicas para los edificios
-        building_positions = [
-            # --- PRIMER CUADRANTE ---
-
-            # ---- Primer edificio ---
-            [(3, height - y) for y in range(3, 10)],  # Edificios en la columna 3 desde la fila 3 a la 9
-            [(3, height - y) for y in range(11, 13)],  # Edificios en la columna 3 desde la fila 11 a la 12
-            [(4, height - y) for y in range(4, 13)],  # Edificios en la columna 4 desde la fila 4 a la 12
-            [(5, height - y) for y in range(3, 12)],   # Edificios en la columna 5 desde la fila 3 a la 11
-            [(6, height - y) for y in range(3, 7)],   # Edificios en la columna 6 desde la fila 3 a la 6
-            [(6, height - y) for y in range(8, 13)],   # Edificios en la columna 6 desde la fila 8 a la 13
-
-            # ---- Segundo edificio ---
-            [(9, height - y) for y in range(3, 6)],  # Edificios en la columna 9 desde la fila 3 a la 5
-            [(9, height - y) for y in range(8, 9)],  # Edificios en la columna 9 desde la fila 8 a la 8
-            [(9, height - y) for y in range(10, 13)],  # Edificios en la columna 9 desde la fila 10 a la 12
-            [(10, height - y) for y in range(3, 6)],  # Edificios en la columna 10 desde la fila 3 a la 5
-            [(10, height - y) for y in range(8, 13)],  # Edificios en la columna 10 desde la fila 8 a la 12
-            [(11, height - y) for y in range(3, 5)],  # Edificios en la columna 11 desde la fila 3 a la 4
-            [(11, height - y) for y in range(8, 12)],  # Edificios en la columna 11 desde la fila 8 a la 11
-            [(12, height - y) for y in range(3, 6)],  # Edificios en la columna 12 desde la fila 3 a la 5
-            [(12, height - y) for y in range(8, 13)],  # Edificios en la columna 12 desde la fila 8 a la 12
-
-
-            # --- SEGUNDO CUADRANTE ---
-            [(17, height - y) for y in range(3, 7)],  # Edificios en la columna 17 desde la fila 3 a la 6
-            [(17, height - y) for y in range(9, 13)],  # Edificios en la columna 17 desde la fila 9 a la 12
-            [(18, height - y) for y in range(4, 7)],  # Edificios en la columna 18 desde la fila 4 a la 6
-            [(18, height - y) for y in range(9, 13)],  # Edificios en la columna 18 desde la fila 9 a la 12
-            [(19, height - y) for y in range(3, 7)],  # Edificios en la columna 19 desde la fila 3 a la 6
-            [(19, height - y) for y in range(9, 13)],  # Edificios en la columna 19 desde la fila 9 a la 12
-            [(20, height - y) for y in range(3, 7)],  # Edificios en la columna 20 desde la fila 3 a la 6
-            [(20, height - y) for y in range(9, 13)],  # Edificios en la columna 20 desde la fila 9 a la 12
-            [(21, height - y) for y in range(3, 6)],  # Edificios en la columna 21 desde la fila 3 a la 5
-            [(21, height - y) for y in range(10, 13)],  # Edificios en la columna 21 desde la fila 10 a la 12
-            [(22, height - y) for y in range(3, 7)],  # Edificios en la columna 22 desde la fila 3 a la 6
-            [(22, height - y) for y in range(9, 13)],  # Edificios en la columna 22 desde la fila 9 a la 12
-
-
-            # --- TERCER CUADRANTE ---
-
-            # ---- Primer edificio ---
-            [(3, height - y) for y in range(17, 19)],  # Edificios en la columna 3 desde la fila 17 a la 18
-            [(3, height - y) for y in range(21, 23)],  # Edificios en la columna 3 desde la fila 21 a la 22
-            [(4, height - y) for y in range(17, 18)],  # Edificios en la columna 4 desde la fila 17 a la 17
-            [(4, height - y) for y in range(21, 23)],  # Edificios en la columna 4 desde la fila 21 a la 22
-            [(5, height - y) for y in range(17, 19)],  # Edificios en la columna 5 desde la fila 17 a la 18
-            [(5, height - y) for y in range(22, 23)],  # Edificios en la columna 5 desde la fila 22 a la 22
-            [(6, height - y) for y in range(17, 19)],  # Edificios en la columna 6 desde la fila 17 a la 18
-            [(6, height - y) for y in range(21, 23)],  # Edificios en la columna 6 desde la fila 21 a la 22
-
-            # ---- Segundo edificio ---
-            [(9, height - y) for y in range(17, 19)],  # Edificios en la columna 9 desde la fila 17 a la 18
-            [(9, height - y) for y in range(21, 23)],  # Edificios en la columna 9 desde la fila 21 a la 22
-            [(10, height - y) for y in range(17, 19)],  # Edificios en la columna 10 desde la fila 17 a la 18
-            [(10, height - y) for y in range(21, 22)],  # Edificios en la columna 10 desde la fila 21 a la 21
-            [(11, height - y) for y in range(18, 19)],  # Edificios en la columna 11 desde la fila 18 a la 18
-            [(11, height - y) for y in range(21, 23)],  # Edificios en la columna 11 desde la fila 21 a la 22
-            [(12, height - y) for y in range(17, 19)],  # Edificios en la columna 12 desde la fila 17 a la 18
-            [(12, height - y) for y in range(21, 23)],  # Edificios en la columna 12 desde la fila 21 a la 22
-
-
-            # --- CUARTO CUADRANTE ---
-
-            # ---- Primer edificio ---
-            [(17, height - y) for y in range(17, 23)],  # Edificios en la columna 17 desde la fila 17 a la 22
-            [(17, height - y) for y in range(17, 23)],  # Edificios en la columna 17 desde la fila 17 a la 22
-            [(18, height - y) for y in range(17, 18)],  # Edificios en la columna 18 desde la fila 17 a la 17
-            [(18, height - y) for y in range(19, 20)],  # Edificios en la columna 18 desde la fila 19 a la 19
-            [(18, height - y) for y in range(21, 23)],  # Edificios en la columna 18 desde la fila 21 a la 22
-            [(21, height - y) for y in range(17, 20)],  # Edificios en la columna 21 desde la fila 17 a la 19
-            [(21, height - y) for y in range(21, 23)],  # Edificios en la columna 21 desde la fila 21 a la 22
-            [(22, height - y) for y in range(17, 23)],  # Edificios en la columna 22 desde la fila 17 a la 22
-        ]
-    
-        # Colocar edificios según las posiciones definidas
-        for positions in building_positions:
-            for pos in positions:
-                if self.grid.is_cell_empty(pos):  # Verificar si la celda está vacía
-                    building = Building(self.next_id(), self)
-                    self.grid.place_agent(building, pos)
-                    self.schedule.add(building)
-    
-        # Coordenadas específicas para los estacionamientos
-        parking_positions = [
-            [(3,height - 10)],
-            [(4,height - 3)],
-            [(5,height - 12)],
-            [(6,height - 7)],
-            [(9,height - 9)],
-            [(11,height - 5)],
-            [(11,height - 12)],
-            [(4,height - 18)],
-            [(5,height - 21)],
-            [(10,height - 22)],
-            [(11,height - 17)],
-            [(18,height - 3)],
-            [(21,height - 6)],
-            [(21,height - 9)],
-            [(18,height - 18)],
-            [(18,height - 20)],
-            [(21,height - 20)],
-        ]
-        
-
-        # Colocar estacionamientos según las posiciones definidas
-        for positions in parking_positions:
-            for pos in positions:
-                if self.grid.is_cell_empty(pos):  # Verificar si la celda está vacía
-                    parking = Parking(self.next_id(), self)
-                    self.grid.place_agent(parking, pos)
-                    self.schedule.add(parking)
-
-        print(f"Estacionamientos colocados en: {parking_positions}")
-
-        # Coordenadas específicas para los semaforos
-        lights_positions = [
-            # --- Semaforos horizontales ---
-            [(x, height - 18) for x in range(1, 3)],
-            [(x, height - 3) for x in range(7, 9)],
-            [(x, height - 8) for x in range(7, 9)],
-            [(x, height - 22) for x in range(7, 9)],
-            [(x, height - 17) for x in range(19, 21)],
-
-            # --- Semaforos verticales ---
-            [(3, height - y) for y in range(19, 21)],
-            [(6, height - y) for y in range(23, 25)],
-            [(9, height - y) for y in range(1, 3)],
-            [(9, height - y) for y in range(6, 8)],
-            [(18, height - y) for y in range(15, 17)],
-        ]
+        layout = self.layout
 
-        # Colocar semaforos según las posiciones definidas
-        for positions in lights_positions:
-            for pos in positions:
-                if self.grid.is_cell_empty(pos):  # Verificar si la celda está vacía
-                    light = TrafficLight(self.next_id(), self)
-                    self.grid.place_agent(light, pos)
-                    self.schedule.add(light)
-        
+        # Colocar edificios según las posiciones definidas: solo se marcan en la capa
+        # estática y en la máscara de obstáculos, sin un agente por celda
+        xs, ys = layout.buildings[:, 0], layout.buildings[:, 1]
+        self.cell_types[xs, ys] = CELL_BUILDING
+        self.obstacles[xs, ys] = True
+        self.obstacle_version += 1
 
-        # Coordenadas específicas para la glorieta
-        roundabouts_positions = [
-            [(14, height - y) for y in range(14, 16)],
-            [(15, height - y) for y in range(14, 16)],
+        # Colocar estacionamientos según las posiciones definidas
+        positions = self._claim_cells(layout.parkings, CELL_PARKING)
+        for pos in positions:
+            parking = Parking(self, pos)
+            self.static_elements[pos] = parking
+            self.parkings[pos] = parking
+        self.free_parkings.update(positions)
+
+        print(f"Estacionamientos colocados en: {layout.parkings}")
+
+        # Colocar semaforos según las posiciones definidas; los ids se reservan de una vez
+        positions = self._claim_cells(layout.lights, CELL_LIGHT)
+        first_id = self.current_id + 1
+        self.current_id += len(positions)
+        for unique_id, pos in enumerate(positions, start=first_id):
+            light = TrafficLight(unique_id, self)
+            self.grid.place_agent(light, pos)
+            self.schedule.add(light)
+            self.lights.append(light)
+
+        # Colocar glorietas según las posiciones definidas
+        for pos in self._claim_cells(layout.roundabouts, CELL_ROUNDABOUT):
+            self.static_elements[pos] = Roundabout(pos)
+
+    def _claim_cells(self, positions, cell_type):
+        """
+        Marca de una vez en la capa estática las celdas libres de la lista y las devuelve en
+        orden; las repetidas y las ya ocupadas se omiten, igual que celda por celda.
+        """
+        cells = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+        keys = cells[:, 0] * self.height + cells[:, 1]
+        order = np.argsort(keys, kind="stable")
+        repeated = np.zeros(len(keys), dtype=bool)
+        repeated[1:] = keys[order][1:] == keys[order][:-1]
+        cells = cells[np.sort(order[~repeated])]
+        xs, ys = cells[:, 0], cells[:, 1]
+        free = (self.cell_types[xs, ys] == CELL_EMPTY) & (self.vehicle_counts[xs, ys] == 0)
+        xs, ys = xs[free], ys[free]
+        self.cell_types[xs, ys] = cell_type
+        return list(zip(xs.tolist(), ys.tolist()))
+
+    # Vecindad de von Neumann de radio 2 sin el centro, en el orden de grid.get_neighborhood
+    LIGHT_ZONE_OFFSETS = tuple(
+        (dx, dy) for dx in range(-2, 3) for dy in range(-2, 3) if 0 < abs(dx) + abs(dy) <= 2
+    )
+
+    def _build_light_zones(self):
+        """
+        Arma la tabla de zonas de semáforos en forma CSR: light_zones da, por celda, su
+        zona (0 es la zona vacía) y los semáforos de la zona z son
+        _zone_lights[_zone_starts[z]:_zone_starts[z + 1]], en el orden de LIGHT_ZONE_OFFSETS.
+        """
+        offsets = np.array(self.LIGHT_ZONE_OFFSETS, dtype=np.int64)
+        lights = np.array([light.pos for light in self.lights], dtype=np.int64).reshape(-1, 2)
+
+        # La celda c ve al semáforo l con el desplazamiento k si c + offsets[k] == l
+        cells = (lights[:, None, :] - offsets[None, :, :]).reshape(-1, 2)
+        light_ids = np.repeat(np.arange(len(lights)), len(offsets))
+        ranks = np.tile(np.arange(len(offsets)), len(lights))
+        inside = (cells >= 0).all(axis=1) & (cells[:, 0] < self.width) & (cells[:, 1] < self.height)
+        keys = cells[inside, 0] * self.height + cells[inside, 1]
+        order = np.lexsort((ranks[inside], keys))
+        keys, light_ids = keys[order], light_ids[inside][order]
+
+        zone_keys, starts = np.unique(keys, return_index=True)
+        self.light_zones = np.zeros((self.width, self.height), dtype=np.int32)
+        self.light_zones.flat[zone_keys] = np.arange(1, len(zone_keys) + 1, dtype=np.int32)
+        self._zone_starts = [0] + starts.tolist() + [len(keys)]
+        self._zone_lights = [self.lights[i] for i in light_ids.tolist()]
+
+    def lights_near(self, pos):
+        """Semáforos en la vecindad de radio 2 de pos, en el mismo orden que grid.get_neighbors."""
+        zone = self.light_zones[pos]
+        return self._zone_lights[self._zone_starts[zone]:self._zone_starts[zone + 1]]
+
+    def cached_route(self, start, policy, compute):
+        """
+        Consulta la caché de rutas del modelo.
+
+        Args:
+            start (tuple): Celda desde donde se pide la ruta.
+            policy (hashable): Qué se busca, por ejemplo "nearest" o ("stops", visitadas).
+            compute (callable): Calcula el valor si no está en caché.
+        """
+        return self.route_cache.get_or_compute(self._route_key(start, policy), compute)
+
+    def _route_key(self, start, policy):
+        return (start, policy, self.parking_version, self.obstacle_version)
+
+    def _plan_routes(self):
+        """
+        Fase de planeación por lotes antes de mover a los agentes.
+
+        Junta las solicitudes de ruta que los vehículos harían en este paso y las resuelve
+        todas juntas: las de estacionamiento más cercano/alcanzable con una sola consulta
+        vectorizada a las tablas y las de Toyota con un BFS en paralelo por frentes (solo en
+        mapas donde ese BFS es barato). Los resultados quedan en la caché de rutas, donde los
+        encuentra cada _calculate_path.
+        """
+        requests = {}
+        for agent in self.all_vehicles():
+            policy = agent.route_request()
+            if policy is not None and self._route_key(agent.pos, policy) not in self.route_cache:
+                requests.setdefault(policy, set()).add(agent.pos)
+
+        free = self.free_parkings
+        if "nearest" in requests:
+            results = self.parking_fields.batch_nearest(requests["nearest"], free)
+            for start, target in results.items():
+                self.route_cache.put(self._route_key(start, "nearest"), target)
+
+        if "reachable" in requests:
+            results = self.parking_fields.batch_reachable(requests["reachable"], free)
+            for start, targets in results.items():
+                self.route_cache.put(self._route_key(start, "reachable"), targets)
+
+        # En mapas grandes el BFS por frentes cuesta más que la búsqueda por tramos que cada
+        # Toyota hace por su cuenta, así que ahí se deja que cada uno la calcule
+        farthest = requests.get("farthest", ())
+        if farthest and len(farthest) * len(self.road_graph) <= self.road_graph.BATCH_LIMIT:
+            graph = self.road_graph
+            starts = [start for start in requests["farthest"] if start in graph]
+            for start in requests["farthest"] - set(starts):
+                self.route_cache.put(self._route_key(start, "farthest"), (None, None))
+            targets = [(parking, graph.node(parking)) for parking in sorted(free) if parking in graph]
+            distances = graph.batch_distances(
+                [graph.node(start) for start in starts], self.obstacles, [node for _, node in targets])
+            for start, row in zip(starts, distances):
+                reached = [(row[node], parking, node) for parking, node in targets if row[node] >= 0]
+                result = (None, None)
+                if reached:
+                    # El más lejano; en empate, el de menor coordenada
+                    _, parking, node = max(reached, key=lambda x: x[0])
+                    result = (parking, graph.path_from_distances(row, node))
+                self.route_cache.put(self._route_key(start, "farthest"), result)
+
+    def add_vehicle(self, agent, pos):
+        """Agenda un vehículo, lo coloca en el grid y lo registra bajo su clase."""
+        self.schedule.add(agent)
+        self.place_vehicle(agent, pos)
+        self.vehicles.setdefault(type(agent), []).append(agent)
+
+    def all_vehicles(self):
+        """Recorre todos los vehículos, agrupados por clase."""
+        for vehicles in self.vehicles.values():
+            yield from vehicles
+
+    def place_vehicle(self, agent, pos):
+        """Coloca un vehículo en el grid y lo cuenta en la capa de ocupación."""
+        self.grid.place_agent(agent, pos)
+        self.vehicle_counts[pos] += 1
+        if not agent.parked:
+            self._hash(agent)
+
+    def move_vehicle(self, agent, pos):
+        """Mueve un vehículo manteniendo sincronizados el grid, la capa de ocupación y el hash espacial."""
+        if not agent.parked:
+            self._unhash(agent)
+        self.vehicle_counts[agent.pos] -= 1
+        self.grid.move_agent(agent, pos)
+        self.vehicle_counts[pos] += 1
+        if not agent.parked:
+            self._hash(agent)
+
+    def park(self, agent):
+        """Marca un vehículo como estacionado; deja de contar para las negociaciones."""
+        if not agent.parked:
+            agent.parked = True
+            self._unhash(agent)
+
+    def unpark(self, agent):
+        """Regresa un vehículo estacionado al tráfico."""
+        if agent.parked:
+            agent.parked = False
+            self._hash(agent)
+
+    def moving_neighbors(self, pos, classes):
+        """
+        Vehículos sin estacionar en las cuatro celdas adyacentes a pos, en el mismo orden
+        que grid.get_neighbors, filtrados por clase.
+        """
+        return [
+            agent
+            for cell in self.grid.get_neighborhood(pos, moore=False, include_center=False)
+            for agent in self.moving_vehicles.get(cell, ())
+            if isinstance(agent, classes)
         ]
 
-        # Colocar semaforos según las posiciones definidas
-        for positions in roundabouts_positions:
-            for pos in positions:
-                if self.grid.is_cell_empty(pos):  # Verificar si la celda está vacía
-                    roundabout = Roundabout(self.next_id(), self)
-                    self.grid.place_agent(roundabout, pos)
-                    self.schedule.add(roundabout)
+    def _hash(self, agent):
+        self.moving_vehicles.setdefault(agent.pos, []).append(agent)
+
+    def _unhash(self, agent):
+        cell = self.moving_vehicles[agent.pos]
+        cell.remove(agent)
+        if not cell:
+            del self.moving_vehicles[agent.pos]
+
+    def is_free(self, pos):
+        """Equivale a grid.is_cell_empty, pero leyendo solo los arreglos."""
+        return self.cell_types[pos] == CELL_EMPTY and self.vehicle_counts[pos] == 0
+
+    def can_enter(self, pos):
+        """Un vehículo puede avanzar a una celda libre o a una con semáforo."""
+        return self.cell_types[pos] == CELL_LIGHT or self.is_free(pos)
+
+    def _resolve_conflicts(self):
+        """
+        Fase de negociación antes de mover a los agentes.
+
+        Arma el grafo de conflictos con los vehículos adyacentes que quieren negociar,
+        resuelve cada pareja una sola vez con Negotiation.resolve y deja a cada vehículo
+        la lista de resultados desde su punto de vista, en el orden de sus vecinos.
+        """
+        pairs = []
+        pair_index = {}
+        neighbors = {}
+        for agent in self.all_vehicles():
+            classes = agent.negotiation_request()
+            if classes is None:
+                continue
+            neighbors[agent] = self.moving_neighbors(agent.pos, classes)
+            for other in neighbors[agent]:
+                key = frozenset((agent.unique_id, other.unique_id))
+                if key not in pair_index:
+                    pair_index[key] = len(pairs)
+                    pairs.append((agent, other))
+
+        outcomes = Negotiation.resolve(pairs, self.negotiation_rng)
+
+        self.negotiations = {}
+        for agent, others in neighbors.items():
+            results = []
+            for other in others:
+                index = pair_index[frozenset((agent.unique_id, other.unique_id))]
+                choice_a, choice_b = outcomes[index]
+                if pairs[index][0] is agent:
+                    results.append((other, choice_a, choice_b))
+                else:
+                    results.append((other, choice_b, choice_a))
+            self.negotiations[agent] = results
+
+    def set_obstacle(self, pos, blocked):
+        """Actualiza la máscara de obstáculos de forma incremental."""
+        if self.obstacles[pos] != blocked:
+            self.obstacles[pos] = blocked
+            self.obstacle_version += 1
+            self.obstacle_log.append(pos)
 
     def random_empty_position(self):
-        while True:
-            x = self.random.randint(1, self.grid.width - 1)
-            y = self.random.randint(1, self.grid.height - 1)
-            if self.grid.is_cell_empty((x, y)):
-                return (x, y)
+        """
+        Saca una celda de carril libre al azar para colocar un vehículo.
+
+        Las celdas salen de una reserva barajada una sola vez, así que cada llamada es O(1)
+        y, cuando ya no queda ninguna libre, se avisa con un error en lugar de ciclar.
+        """
+        if self._spawn_pool is None:
+            graph = self.road_graph
+            free = (self.cell_types[graph._xs, graph._ys] == CELL_EMPTY) & (self.vehicle_counts[graph._xs, graph._ys] == 0)
+            cells = np.flatnonzero(free)
+            rng = np.random.default_rng(self.random.getrandbits(64))
+            self._spawn_pool = cells[rng.permutation(len(cells))].tolist()
+        while self._spawn_pool:
+            pos = self.road_graph.position(self._spawn_pool.pop())
+            if self.is_free(pos):
+                return pos
+        raise RuntimeError("No quedan celdas de carril libres para colocar más vehículos.")
     
     def step(self):
+        self._plan_routes()
+        self._resolve_conflicts()
         self.schedule.step()
         self.datacollector.collect(self)
 
         # Verificar si todos los vehículos están estacionados
-        all_parked = all(agent.parked for agent in self.schedule.agents if isinstance(agent, Vehicle))
+        all_parked = all(agent.parked for agent in self.vehicles.get(Vehicle, []))
         if all_parked:
             print("Todos los vehículos están estacionados. Terminando simulación.")
             self.running = False
@@ -7,7 +7,8 @@ from Moto import Moto
 from Jeep import Jeeps
 from Toyota import Toyota
 from Ferrari_model import TrafficSimulation
-from Mapa import Building, Parking, Roundabout
+import numpy as np
+from Mapa import CELL_BUILDING, CELL_PARKING, CELL_ROUNDABOUT
 
 # Configura el modelo
 model = TrafficSimulation(width=25, height=25, num_vehicles=5, num_microbus=5, num_moto=5, num_jeeps=5, num_toyota=5)
@@ -33,10 +34,16 @@ def render_model(model, ax):
 
      # Dibujamos los carriles como líneas delgadas naranjas
     for lane in model.lanes_positions:
-        x_values = [coord[0] + 0.5 for coord in lane.positions]  # Ajusta la posición en X para centrar la línea
-        y_values = [coord[1] + 0.5 for coord in lane.positions]  # Ajusta la posición en Y para centrar la línea
+        x_values = lane.positions[:, 0] + 0.5  # Ajusta la posición en X para centrar la línea
+        y_values = lane.positions[:, 1] + 0.5  # Ajusta la posición en Y para centrar la línea
         ax.plot(x_values, y_values, color="orange", linewidth=2)  # Dibuja la línea delgada
 
+    # Dibuja la capa estática del mapa: edificios, estacionamientos y glorietas
+    for cell_type, color in ((CELL_BUILDING, "blue"), (CELL_PARKING, "yellow"), (CELL_ROUNDABOUT, "brown")):
+        for x, y in np.argwhere(model.cell_types == cell_type).tolist():
+            rect = patches.Rectangle((x, y), 1, 1, color=color)
+            ax.add_patch(rect)
+
     # Dibuja agentes según su tipo
     for (content, pos) in model.grid.coord_iter():
         x, y = pos
@@ -65,15 +72,6 @@ def render_model(model, ax):
                 color = "#B21F9A" if agent.state == "FELIZ" else "red"
                 circle = patches.Circle((x + 0.5, y + 0.5), radius=0.4, color=color, ec="black")  
                 ax.add_patch(circle)
-            elif isinstance(agent, Building):
-                rect = patches.Rectangle((x, y), 1, 1, color="blue")
-                ax.add_patch(rect)
-            elif isinstance(agent, Parking):
-                rect = patches.Rectangle((x, y), 1, 1, color="yellow")  
-                ax.add_patch(rect)
-            elif isinstance(agent, Roundabout):
-                rect = patches.Rectangle((x, y), 1, 1, color="brown")  
-                ax.add_patch(rect)
 
 # Bucle de simulación
 for i in range(300):  # Máximo de pasos
@@ -0,0 +1,1151 @@
+import heapq
+import weakref
+from collections import OrderedDict
+from functools import cached_property
+import numpy as np
+
+class RoadGraph:
+    """
+    Grafo dirigido de los carriles, compilado una sola vez a partir de los Lane del modelo.
+
+    Cada celda de carril recibe un id entero y las adyacencias se guardan en arreglos
+    tipo CSR (offsets, targets, weights), así los vehículos ya no reconstruyen el grafo
+    en cada cálculo de ruta.
+    """
+
+    BATCH_LIMIT = 250_000  # Máximo de orígenes x nodos para usar batch_distances
+
+    def __init__(self, lanes):
+        # Los ids siguen el orden de las coordenadas, así los empates en las colas de
+        # prioridad se resuelven igual que cuando los nodos eran tuplas (x, y)
+        cells = [lane.positions for lane in lanes]
+        all_cells = np.concatenate(cells).astype(np.int64) if cells else np.empty((0, 2), dtype=np.int64)
+
+        # Cada celda se codifica como x * span + y: ordenar las llaves es ordenar por coordenada
+        span = int(all_cells[:, 1].max()) + 1 if len(all_cells) else 1
+        keys = np.sort(all_cells[:, 0] * span + all_cells[:, 1])
+        unique = np.ones(len(keys), dtype=bool)
+        unique[1:] = keys[1:] != keys[:-1]
+        keys = keys[unique]
+        positions = np.column_stack([keys // span, keys % span])
+        sources = np.concatenate([lane[:-1] for lane in cells]).astype(np.int64) if cells else all_cells
+        targets = np.concatenate([lane[1:] for lane in cells]).astype(np.int64) if cells else all_cells
+        sources = np.searchsorted(keys, sources[:, 0] * span + sources[:, 1])
+        targets = np.searchsorted(keys, targets[:, 0] * span + targets[:, 1])
+
+        # Los carriles que se enciman no duplican aristas; se conserva la primera aparición
+        edge_keys = sources * len(positions) + targets
+        order = np.argsort(edge_keys, kind="stable")
+        repeated = np.zeros(len(edge_keys), dtype=bool)
+        repeated[1:] = edge_keys[order][1:] == edge_keys[order][:-1]
+        first = np.sort(order[~repeated])
+        sources, targets = sources[first], targets[first]
+
+        # Ordenamiento estable: se respeta el orden de los carriles para cada nodo
+        order = np.argsort(sources, kind="stable")
+        edges = np.column_stack([sources[order], targets[order], np.ones(len(order), dtype=np.int64)])
+        self._compile(positions, edges)
+
+    @classmethod
+    def from_arrays(cls, positions, edges):
+        """
+        Reconstruye el grafo a partir de los arreglos de to_arrays, sin volver a recorrer carriles.
+
+        Args:
+            positions (ndarray): Arreglo (N, 2) con la posición de cada nodo, en orden de id.
+            edges (ndarray): Arreglo (E, 3) con (origen, destino, peso), ordenado por origen.
+        """
+        graph = cls.__new__(cls)
+        graph._compile(positions, edges)
+        return graph
+
+    def to_arrays(self):
+        """Devuelve (positions, edges) como arreglos int32, listos para guardarse en disco."""
+        positions = np.column_stack([self._xs, self._ys]).astype(np.int32)
+        edges = np.column_stack([self._sources, self.targets, self.weights]).astype(np.int32)
+        return positions.reshape(-1, 2), edges.reshape(-1, 3)
+
+    def _compile(self, positions, edges):
+        """Arma las tablas CSR y los arreglos de búsqueda a partir de nodos y aristas ya ordenadas."""
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 3)
+        count = len(positions)
+
+        # Posiciones como arreglos por coordenada y un índice denso celda -> id; armar
+        # tuplas y un diccionario por nodo es lo que más costaba en mapas grandes
+        self._xs = positions[:, 0].copy()
+        self._ys = positions[:, 1].copy()
+        self._x_list = self._xs.tolist()
+        self._y_list = self._ys.tolist()
+        self._width = int(self._xs.max()) + 1 if count else 0
+        self._height = int(self._ys.max()) + 1 if count else 0
+        self._index = np.full((self._width, self._height), -1, dtype=np.int32)
+        self._index[self._xs, self._ys] = np.arange(count, dtype=np.int32)
+        offsets = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edges[:, 0], minlength=count), out=offsets[1:])
+        self.offsets = tuple(offsets.tolist())
+        self.targets = tuple(edges[:, 1].tolist())
+        self.weights = tuple(edges[:, 2].tolist())
+        self._offsets = offsets
+        self._sources = edges[:, 0]
+        self._targets = edges[:, 1]
+
+        # Arreglos NumPy para las búsquedas por lotes: aristas agrupadas por destino
+        by_target = np.argsort(edges[:, 1], kind="stable")
+        in_degree = np.bincount(edges[:, 1], minlength=count)
+        self._in_sources = edges[by_target, 0]
+        self._in_nodes = np.flatnonzero(in_degree)  # Nodos con al menos una arista de entrada
+        self._in_starts = (np.cumsum(in_degree) - in_degree)[self._in_nodes]
+
+    @cached_property
+    def _successors(self):
+        # Tuplas (vecino, peso) por nodo; se arman la primera vez que una búsqueda las pide
+        offsets, targets, weights = self.offsets, self.targets, self.weights
+        return tuple(
+            tuple(zip(targets[offsets[i]:offsets[i + 1]], weights[offsets[i]:offsets[i + 1]]))
+            for i in range(len(self))
+        )
+
+    @cached_property
+    def _predecessors(self):
+        predecessors = [[] for _ in range(len(self))]
+        for source, target, weight in zip(self._sources.tolist(), self.targets, self.weights):
+            predecessors[target].append((source, weight))
+        return tuple(tuple(pairs) for pairs in predecessors)
+
+    def __len__(self):
+        return len(self._x_list)
+
+    def __contains__(self, pos):
+        return self.node(pos) is not None
+
+    def node(self, pos):
+        """Devuelve el id del nodo en la posición dada o None si no es carril."""
+        x, y = pos
+        if 0 <= x < self._width and 0 <= y < self._height:
+            node = int(self._index[x, y])
+            if node >= 0:
+                return node
+        return None
+
+    def nodes(self, positions):
+        """Ids de las posiciones que son carril, sin repetir."""
+        return {node for node in map(self.node, positions) if node is not None}
+
+    def position(self, node):
+        """Devuelve la posición (x, y) del nodo."""
+        return (self._x_list[node], self._y_list[node])
+
+    def successors(self, node):
+        """Devuelve las parejas (vecino, peso) que salen del nodo."""
+        return self._successors[node]
+
+    def predecessors(self, node):
+        """Devuelve las parejas (vecino, peso) que entran al nodo."""
+        return self._predecessors[node]
+
+    def shortest_path(self, start, goal):
+        """
+        Algoritmo de Dijkstra para encontrar la ruta más corta entre dos posiciones.
+
+        Returns:
+            list: Posiciones desde start hasta goal (ambas incluidas) o [] si no hay camino.
+        """
+        return self.nearest_path(start, (goal,))
+
+    def nearest_path(self, start, goals):
+        """
+        Dijkstra de una sola fuente que se detiene en el primer objetivo que se asienta.
+
+        Sustituye a correr una búsqueda por cada objetivo y quedarse con la más corta: el
+        primer objetivo extraído de la cola es el más cercano (en empate, el de menor
+        coordenada).
+
+        Args:
+            start (tuple): Posición de origen.
+            goals (iterable): Posiciones objetivo.
+
+        Returns:
+            list: Posiciones desde start hasta el objetivo más cercano o [] si no hay camino.
+        """
+        goals = set(goals)
+        if start in goals:
+            return [start]
+        source = self.node(start)
+        targets = self.nodes(goals)
+        if source is None or not targets:
+            return []
+
+        queue = [(0, source)]
+        distances = {source: 0}
+        previous_nodes = {source: None}
+
+        while queue:
+            current_distance, current_node = heapq.heappop(queue)
+
+            if current_node in targets:
+                return self.reconstruct(previous_nodes, current_node)
+
+            for neighbor, weight in self._successors[current_node]:
+                distance = current_distance + weight
+                if neighbor not in distances or distance < distances[neighbor]:
+                    distances[neighbor] = distance
+                    heapq.heappush(queue, (distance, neighbor))
+                    previous_nodes[neighbor] = current_node
+
+        return []
+
+    def search(self, start, goals=(), blocked=None):
+        """
+        Dijkstra completo desde start, útil para consultar todos los objetivos con una búsqueda.
+
+        Args:
+            start (tuple): Posición de origen.
+            goals (iterable): Posiciones que nunca se consideran bloqueadas.
+            blocked (numpy.ndarray): Máscara booleana indexada por (x, y) con las celdas que
+                no se pueden atravesar; None si no hay obstáculos.
+
+        Returns:
+            tuple: (distances, previous_nodes), ambos indexados por id de nodo.
+        """
+        source = self.node(start)
+        if source is None:
+            return {}, {}
+        goals = self.nodes(goals)
+
+        queue = [(0, source)]
+        distances = {source: 0}
+        previous_nodes = {source: None}
+
+        while queue:
+            current_distance, current_node = heapq.heappop(queue)
+            if current_distance > distances[current_node]:
+                continue
+
+            for neighbor, weight in self._successors[current_node]:
+                if blocked is not None and neighbor not in goals and blocked[self._x_list[neighbor], self._y_list[neighbor]]:
+                    continue  # Celda bloqueada por un obstáculo
+                distance = current_distance + weight
+                if neighbor not in distances or distance < distances[neighbor]:
+                    distances[neighbor] = distance
+                    heapq.heappush(queue, (distance, neighbor))
+                    previous_nodes[neighbor] = current_node
+
+        return distances, previous_nodes
+
+    def batch_distances(self, starts, blocked=None, exempt=()):
+        """
+        BFS en paralelo por frentes desde varios orígenes a la vez.
+
+        Todos los frentes avanzan juntos un nivel por iteración con operaciones vectorizadas
+        sobre arreglos (orígenes x nodos), así el trabajo se comparte entre vehículos. Cada
+        nivel recorre todas las aristas, así que solo conviene mientras orígenes x nodos no
+        rebase BATCH_LIMIT; en mapas grandes es más barata una búsqueda por tramos por vehículo.
+
+        Args:
+            starts (list): Ids de nodo de origen.
+            blocked (numpy.ndarray): Máscara (x, y) de celdas bloqueadas o None.
+            exempt (iterable): Ids de nodo que nunca se consideran bloqueados.
+
+        Returns:
+            numpy.ndarray: Distancias (len(starts), len(self)); -1 si el nodo no es alcanzable.
+        """
+        count = len(starts)
+        distances = np.full((count, len(self)), -1, dtype=np.int32)
+        if not count or not len(self._in_sources):
+            distances[np.arange(count), starts] = 0
+            return distances
+
+        passable = np.ones(len(self), dtype=bool)
+        if blocked is not None:
+            passable = ~blocked[self._xs, self._ys]
+            passable[list(exempt)] = True
+
+        frontier = np.zeros((count, len(self)), dtype=bool)
+        frontier[np.arange(count), starts] = True
+        distances[frontier] = 0
+        level = 0
+        while frontier.any():
+            level += 1
+            reached = np.zeros_like(frontier)
+            reached[:, self._in_nodes] = np.logical_or.reduceat(
+                frontier[:, self._in_sources], self._in_starts, axis=1)
+            reached &= passable
+            reached &= distances < 0
+            distances[reached] = level
+            frontier = reached
+        return distances
+
+    def path_from_distances(self, distances, goal):
+        """Reconstruye hacia atrás una ruta más corta usando una fila de batch_distances."""
+        if distances[goal] < 0:
+            return []
+        path = [goal]
+        while distances[path[-1]] > 0:
+            level = distances[path[-1]] - 1
+            path.append(min(
+                source for source, _ in self._predecessors[path[-1]] if distances[source] == level
+            ))
+        return [self.position(node) for node in reversed(path)]
+
+    def reconstruct(self, previous_nodes, node):
+        """Reconstruye la lista de posiciones siguiendo los predecesores hasta el origen."""
+        path = []
+        while node is not None:
+            path.append(self.position(node))
+            node = previous_nodes[node]
+        return path[::-1]
+
+
+class Route:
+    """
+    Ruta de celdas que se expande de forma perezosa a partir de tramos.
+
+    Guarda referencias a las tuplas de celdas de cada segmento y solo avanza sobre ellas
+    conforme el vehículo consume la ruta, sin construir la lista completa. Ofrece la misma
+    interfaz que usan los vehículos con las listas (len, [0], pop(0)).
+    """
+
+    def __init__(self, chunks):
+        self._chunks = [chunk for chunk in chunks if chunk]
+        self._offset = 0  # Celdas ya consumidas del primer tramo
+        self._length = sum(len(chunk) for chunk in self._chunks)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        if self._chunks:
+            yield from self._chunks[0][self._offset:]
+            for chunk in self._chunks[1:]:
+                yield from chunk
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("Route index out of range")
+        index += self._offset
+        for chunk in self._chunks:
+            if index < len(chunk):
+                return chunk[index]
+            index -= len(chunk)
+
+    def pop(self, index=0):
+        """Consume la primera celda de la ruta (solo se admite index=0)."""
+        if index != 0:
+            raise ValueError("Route only supports pop(0)")
+        cell = self[0]
+        self._offset += 1
+        self._length -= 1
+        if self._offset == len(self._chunks[0]):
+            self._chunks.pop(0)
+            self._offset = 0
+        return cell
+
+    def copy(self):
+        route = Route(())
+        route._chunks = list(self._chunks)
+        route._offset = self._offset
+        route._length = self._length
+        return route
+
+
+class SegmentGraph:
+    """
+    Versión contraída del grafo de carriles.
+
+    Los nodos son solo los extremos de carril, los cruces (grado de entrada o salida distinto
+    de uno) y las entradas a estacionamientos; cada arista es un tramo con su longitud y la
+    tupla de celdas que lo forman (cells, armada al pedirse). Las búsquedas escalan con el número de intersecciones y no
+    con el número de celdas.
+    """
+
+    def __init__(self, graph, entrances=()):
+        self.graph = graph
+        count = len(graph)
+        offsets, sources, targets = graph._offsets, graph._sources, graph._targets
+        nodes = np.arange(count)
+
+        # Nodos clave: grado de entrada o de salida distinto de uno, más las entradas
+        out_degree = np.diff(offsets)
+        in_degree = np.bincount(targets, minlength=count)
+        is_key = (out_degree != 1) | (in_degree != 1)
+        is_key[list(graph.nodes(entrances))] = True
+        key_list = np.flatnonzero(is_key).tolist()
+        self.keys = frozenset(key_list)
+
+        # Los nodos de paso tienen un solo sucesor y un solo predecesor; los clave se apuntan
+        # a sí mismos. Con duplicación de punteros se obtiene, para cada nodo, el primer nodo
+        # clave al que llega (end) y en cuántos pasos (steps), sin recorrer celda por celda
+        passing = ~is_key
+        follow = nodes.copy()
+        follow[passing] = targets[offsets[:-1][passing]]
+        end, steps = follow, passing.astype(np.int64)
+        for _ in range(max(count, 1).bit_length()):
+            steps = steps + steps[end]
+            end = end[end]
+
+        # Un tramo por arista que sale de un nodo clave; los que caen en un ciclo sin cruces
+        # nunca llegan a otro nodo clave y se descartan
+        from_key = is_key[sources]
+        origins, firsts = sources[from_key], targets[from_key]
+        valid = is_key[end[firsts]]
+        origins, firsts = origins[valid], firsts[valid]
+        destinations, lengths = end[firsts], steps[firsts] + 1
+
+        # Cabeza de cada nodo de paso (la primera celda de su tramo), duplicando hacia atrás
+        previous = nodes.copy()
+        previous[targets] = sources
+        head = np.where(passing & ~is_key[previous], previous, nodes)
+        for _ in range(max(count, 1).bit_length()):
+            head = head[head]
+        edge_of_first = np.full(count, -1, dtype=np.int64)
+        edge_of_first[firsts] = np.arange(len(firsts))
+        inner = np.flatnonzero(passing & is_key[end])
+
+        self.edges = list(zip(origins.tolist(), destinations.tolist(), lengths.tolist()))  # (origen, destino, longitud)
+        self.interior = dict(zip(  # Nodo interior -> (id de arista, índice dentro de sus celdas)
+            inner.tolist(),
+            zip(edge_of_first[head[inner]].tolist(), (steps[head[inner]] - steps[inner]).tolist()),
+        ))
+        self.adjacency = {key: [] for key in key_list}
+        self._links = {key: [] for key in key_list}  # (arista, destino, longitud) para search
+        for edge, (origin, destination, length) in enumerate(self.edges):
+            self.adjacency[origin].append(edge)
+            self._links[origin].append((edge, destination, length))
+        self._firsts = firsts.tolist()
+        self._follow = follow.tolist()
+        self._cells = {}  # Arista -> tupla de celdas, se arma la primera vez que se pide
+
+        self._blocked_state = None  # (máscara, posición de la bitácora) con que se armó el conjunto
+        self._blocked_cells = set()  # Nodos interiores bloqueados
+        self._blocked_counts = {}  # Arista -> número de celdas interiores bloqueadas
+
+    def __len__(self):
+        return len(self.keys)
+
+    def cells(self, edge):
+        """Tupla de celdas del tramo, de la primera después del origen hasta el destino."""
+        cells = self._cells.get(edge)
+        if cells is None:
+            follow, position = self._follow, self.graph.position
+            node = self._firsts[edge]
+            path = [position(node)]
+            for _ in range(self.edges[edge][2] - 1):
+                node = follow[node]
+                path.append(position(node))
+            cells = self._cells[edge] = tuple(path)
+        return cells
+
+    def _blocked_edges(self, blocked, log):
+        """
+        Aristas con alguna celda interior bloqueada. Con la bitácora de obstáculos solo se
+        revisan las celdas que cambiaron desde la última llamada; sin ella, o si la bitácora
+        ya se compactó más allá, se recorre la máscara completa.
+        """
+        state = self._blocked_state
+        changed = None
+        if log is not None and state is not None and state[0] is blocked:
+            changed = log.since(state[1])
+
+        cells = self._blocked_cells
+        counts = self._blocked_counts
+        if changed is None:
+            cells.clear()
+            counts.clear()
+            for x, y in zip(*np.nonzero(blocked)):
+                node = self.graph.node((int(x), int(y)))
+                if node in self.interior:
+                    cells.add(node)
+                    edge = self.interior[node][0]
+                    counts[edge] = counts.get(edge, 0) + 1
+        else:
+            for pos in set(changed):
+                node = self.graph.node(pos)
+                if node not in self.interior:
+                    continue
+                edge = self.interior[node][0]
+                if blocked[pos] and node not in cells:
+                    cells.add(node)
+                    counts[edge] = counts.get(edge, 0) + 1
+                elif not blocked[pos] and node in cells:
+                    cells.discard(node)
+                    counts[edge] -= 1
+                    if not counts[edge]:
+                        del counts[edge]
+
+        self._blocked_state = (blocked, log.end) if log is not None else None
+        return counts
+
+    def search(self, start, goals=(), blocked=None, log=None, until=None):
+        """
+        Dijkstra sobre los tramos desde start, equivalente a RoadGraph.search.
+
+        Args:
+            start (tuple): Posición de origen (cualquier celda de carril).
+            goals (iterable): Posiciones objetivo; deben ser nodos clave (entradas).
+            blocked (numpy.ndarray): Máscara (x, y) de celdas bloqueadas o None.
+            log (ObstacleLog): Bitácora de la máscara; permite actualizar las aristas bloqueadas
+                solo con las celdas que cambiaron.
+            until (iterable): Posiciones clave; la búsqueda se detiene en cuanto asienta la
+                primera de ellas (la más cercana; en empate, la de menor coordenada). Solo las
+                distancias de los nodos asentados son definitivas.
+
+        Returns:
+            tuple: (distances, previous) indexados por nodo clave; previous guarda (nodo, arista)
+            y para el nodo de entrada (None, prefijo de celdas desde start).
+        """
+        graph = self.graph
+        node = graph.node(start)
+        if node is None:
+            return {}, {}
+        goals = graph.nodes(goals)
+        stop = graph.nodes(until) if until is not None else None
+        blocked_edges = self._blocked_edges(blocked, log) if blocked is not None else frozenset()
+
+        def is_blocked(key):
+            return blocked is not None and key not in goals and blocked[graph.position(key)]
+
+        if node in self.keys:
+            entry, prefix = node, (start,)
+        else:
+            if node not in self.interior:
+                return {}, {}  # Ciclo sin cruces
+            # Avanzar por el único camino posible hasta el primer nodo clave
+            edge, index = self.interior[node]
+            entry = self.edges[edge][1]
+            cells = self.cells(edge)
+            prefix = (start,) + cells[index + 1:]
+            if blocked is not None and any(blocked[cell] for cell in cells[index + 1:-1]):
+                return {}, {}
+            if is_blocked(entry):
+                return {}, {}
+
+        distances = {entry: len(prefix) - 1}
+        previous = {entry: (None, prefix)}
+        queue = [(distances[entry], entry)]
+        while queue:
+            current_distance, current = heapq.heappop(queue)
+            if current_distance > distances[current]:
+                continue
+            if stop is not None and current in stop:
+                break
+            for edge, target, length in self._links[current]:
+                if blocked is not None and (edge in blocked_edges or is_blocked(target)):
+                    continue
+                distance = current_distance + length
+                if target not in distances or distance < distances[target]:
+                    distances[target] = distance
+                    previous[target] = (current, edge)
+                    heapq.heappush(queue, (distance, target))
+
+        return distances, previous
+
+    def route(self, previous, goal):
+        """Arma la Route perezosa hasta el nodo clave goal a partir de los predecesores."""
+        chunks = []
+        node = goal
+        while True:
+            parent, link = previous[node]
+            if parent is None:
+                chunks.append(link)  # Prefijo desde la celda de inicio
+                break
+            chunks.append(self.cells(link))
+            node = parent
+        return Route(chunks[::-1])
+
+
+class DistanceFields:
+    """
+    Campos de distancia inversos y tablas de siguiente salto hacia un conjunto fijo de destinos.
+
+    Para cada destino se corre una sola vez un Dijkstra inverso sobre el grafo de carriles y
+    se guarda, por nodo, la distancia al destino y el siguiente nodo a tomar. Elegir destino
+    o avanzar un paso es entonces una consulta O(1) a las tablas, sin búsquedas.
+
+    Las tablas densas ocupan destinos x nodos; si eso rebasa DENSE_LIMIT (mapas grandes) no se
+    arman. Las consultas se responden entonces con búsquedas sobre el grafo de tramos, y los
+    siguientes saltos de cada ruta encontrada se guardan por destino en una caché acotada.
+    """
+
+    UNREACHABLE = np.iinfo(np.int32).max
+    DENSE_LIMIT = 1_000_000  # Máximo de celdas destinos x nodos para armar tablas densas
+    MAX_ROUTED_TARGETS = 256  # Destinos con siguientes saltos guardados en modo disperso
+
+    def __init__(self, graph, targets, segments=None):
+        """
+        Args:
+            graph (RoadGraph): Grafo de carriles.
+            targets (iterable): Posiciones destino.
+            segments (SegmentGraph): Grafo de tramos cuyos nodos clave incluyen los destinos;
+                solo se usa en modo disperso y, si no se da, se arma cuando se necesita.
+        """
+        self.graph = graph
+        # Filas ordenadas por coordenada para que los empates favorezcan la menor posición
+        self.targets = tuple(sorted(set(targets)))
+        self.rows = {target: row for row, target in enumerate(self.targets)}
+        self.distances = None
+        self.next_hops = None
+        self._segments = segments
+        self._hops = OrderedDict()  # Destino -> {nodo: (siguiente nodo, distancia)}
+        self._last_search = (None, None, None)  # (posición, distancias, predecesores)
+        if len(self.targets) * len(graph) <= self.DENSE_LIMIT:
+            self.distances = np.full((len(self.targets), len(graph)), self.UNREACHABLE, dtype=np.int32)
+            self.next_hops = np.full((len(self.targets), len(graph)), -1, dtype=np.int32)
+            for row, target in enumerate(self.targets):
+                self._reverse_search(row, graph.node(target))
+
+    @classmethod
+    def from_arrays(cls, graph, targets, distances, next_hops):
+        """
+        Reutiliza tablas ya calculadas (por ejemplo, arreglos mapeados desde disco).
+
+        Args:
+            graph (RoadGraph): Grafo con el que se calcularon las tablas.
+            targets (iterable): Destinos en el orden de las filas.
+            distances (ndarray): Tabla (T, N) de distancias.
+            next_hops (ndarray): Tabla (T, N) de siguiente salto.
+        """
+        fields = cls.__new__(cls)
+        fields.graph = graph
+        fields.targets = tuple(tuple(target) for target in np.asarray(targets).reshape(-1, 2).tolist())
+        fields.rows = {target: row for row, target in enumerate(fields.targets)}
+        fields.distances = distances
+        fields.next_hops = next_hops
+        fields._segments = None
+        fields._hops = OrderedDict()
+        fields._last_search = (None, None, None)
+        return fields
+
+    @property
+    def dense(self):
+        """True si las consultas se responden con las tablas precalculadas."""
+        return self.distances is not None
+
+    def _reverse_search(self, row, goal):
+        """Dijkstra inverso desde el destino siguiendo las aristas entrantes."""
+        if goal is None:
+            return
+        distances = self.distances[row]
+        next_hops = self.next_hops[row]
+        distances[goal] = 0
+        queue = [(0, goal)]
+        while queue:
+            current_distance, current_node = heapq.heappop(queue)
+            if current_distance > distances[current_node]:
+                continue
+            for neighbor, weight in self.graph.predecessors(current_node):
+                distance = current_distance + weight
+                if distance < distances[neighbor]:
+                    distances[neighbor] = distance
+                    next_hops[neighbor] = current_node
+                    heapq.heappush(queue, (distance, neighbor))
+
+    def _search(self, pos, until=None):
+        """
+        Búsqueda sobre el grafo de tramos desde pos (modo disperso). Con until se detiene en el
+        primer destino asentado; las búsquedas completas se guardan para la siguiente consulta.
+        """
+        last_pos, distances, previous = self._last_search
+        if last_pos == pos:
+            return distances, previous
+        if self._segments is None:
+            self._segments = SegmentGraph(self.graph, self.targets)
+        distances, previous = self._segments.search(pos, until=until)
+        if until is None:
+            self._last_search = (pos, distances, previous)
+        return distances, previous
+
+    def _route_hops(self, target, node, pos):
+        """
+        Siguiente salto y distancia desde node hacia target en modo disperso. Al encontrar una
+        ruta se guardan los saltos de todas sus celdas, así el resto del trayecto es O(1).
+        """
+        hops = self._hops.get(target)
+        if hops is None:
+            hops = self._hops[target] = {}
+            if len(self._hops) > self.MAX_ROUTED_TARGETS:
+                self._hops.popitem(last=False)
+        else:
+            self._hops.move_to_end(target)
+        if node in hops:
+            return hops[node]
+
+        distances, previous = self._search(pos, until=(target,))
+        goal = self.graph.node(target)
+        if goal not in distances:
+            hops[node] = (-1, None)
+            return hops[node]
+        cells = list(self._segments.route(previous, goal))
+        length = len(cells) - 1
+        nodes = [self.graph.node(cell) for cell in cells]
+        for index in range(length):
+            hops[nodes[index]] = (nodes[index + 1], length - index)
+        hops[goal] = (-1, 0)
+        return hops[node]
+
+    def distance(self, target, pos):
+        """Distancia desde pos hasta el destino o None si no hay camino."""
+        if pos == target:
+            return 0
+        node = self.graph.node(pos)
+        if node is None or target not in self.rows:
+            return None
+        if self.distances is None:
+            hops = self._hops.get(target)
+            if hops is not None and node in hops:
+                return hops[node][1]
+            distance = self._search(pos)[0].get(self.graph.node(target))
+            return None if distance is None else int(distance)
+        distance = self.distances[self.rows[target], node]
+        return None if distance == self.UNREACHABLE else int(distance)
+
+    def next_hop(self, target, pos):
+        """Siguiente posición a tomar desde pos para llegar al destino o None si no hay camino."""
+        node = self.graph.node(pos)
+        if node is None or target not in self.rows:
+            return None
+        if self.distances is None:
+            next_node = self._route_hops(target, node, pos)[0]
+        else:
+            next_node = self.next_hops[self.rows[target], node]
+        return None if next_node < 0 else self.graph.position(next_node)
+
+    def nearest(self, pos, candidates):
+        """Devuelve el destino alcanzable más cercano a pos entre los candidatos o None."""
+        if pos in candidates:
+            return pos
+        known = [target for target in sorted(candidates) if target in self.rows]
+        node = self.graph.node(pos)
+        if node is None or not known:
+            return None
+        if self.distances is None:
+            distances = self._search(pos, until=known)[0]
+            column = [distances.get(self.graph.node(target), self.UNREACHABLE) for target in known]
+            best = min(range(len(known)), key=column.__getitem__)
+        else:
+            column = self.distances[[self.rows[target] for target in known], node]
+            best = int(column.argmin())
+        if column[best] == self.UNREACHABLE:
+            return None
+        return known[best]
+
+    def batch_nearest(self, starts, candidates):
+        """
+        Versión vectorizada de nearest para muchas posiciones de inicio a la vez.
+
+        Returns:
+            dict: Posición de inicio -> destino más cercano o None.
+        """
+        if self.distances is None:
+            return {start: self.nearest(start, candidates) for start in set(starts)}
+        candidates = sorted(target for target in candidates if target in self.rows)
+        results = {}
+        nodes = []
+        for start in set(starts):
+            if start in candidates:
+                results[start] = start
+            elif self.graph.node(start) is None or not candidates:
+                results[start] = None
+            else:
+                nodes.append(start)
+        if nodes:
+            rows = [self.rows[target] for target in candidates]
+            columns = [self.graph.node(start) for start in nodes]
+            block = self.distances[np.ix_(rows, columns)]
+            best = block.argmin(axis=0)
+            found = block[best, np.arange(len(columns))] != self.UNREACHABLE
+            for start, index, ok in zip(nodes, best, found):
+                results[start] = candidates[index] if ok else None
+        return results
+
+    def batch_reachable(self, starts, candidates):
+        """
+        Versión vectorizada de reachable para muchas posiciones de inicio a la vez.
+
+        Returns:
+            dict: Posición de inicio -> tupla de destinos alcanzables.
+        """
+        candidates = sorted(candidates)
+        if self.distances is None:
+            return {
+                start: tuple(target for target in candidates
+                             if target == start or self.distance(target, start) is not None)
+                for start in set(starts)
+            }
+        results = {}
+        nodes = []
+        for start in set(starts):
+            if self.graph.node(start) is None:
+                results[start] = tuple(target for target in candidates if target == start)
+            else:
+                nodes.append(start)
+        known = [target for target in candidates if target in self.rows]
+        if nodes and known:
+            rows = [self.rows[target] for target in known]
+            columns = [self.graph.node(start) for start in nodes]
+            block = self.distances[np.ix_(rows, columns)] != self.UNREACHABLE
+            for column, start in enumerate(nodes):
+                results[start] = tuple(
+                    target for target, ok in zip(known, block[:, column]) if ok or target == start)
+        else:
+            for start in nodes:
+                results[start] = tuple(target for target in candidates if target == start)
+        return results
+
+    def reachable(self, pos, candidates):
+        """Filtra los candidatos a los que se puede llegar desde pos."""
+        return [target for target in candidates if self.distance(target, pos) is not None]
+
+    def route(self, pos, target):
+        """Materializa la ruta completa (pos incluida) siguiendo las tablas de siguiente salto."""
+        if self.distance(target, pos) is None:
+            return []
+        path = [pos]
+        while path[-1] != target:
+            path.append(self.next_hop(target, path[-1]))
+        return path
+
+
+class StopRegistry:
+    """
+    Registro de paradas de microbús con su matriz de distancias entre todas las paradas.
+
+    La matriz sale de los campos de distancia inversos de cada parada, así que se calcula
+    una sola vez junto con el mapa; planear un recorrido ya no necesita búsquedas.
+    """
+
+    def __init__(self, graph, stops, fields=None):
+        # Se pueden pasar campos ya calculados para las mismas paradas, como los del caché del mapa
+        self.fields = fields if fields is not None else DistanceFields(graph, stops)
+        self.stops = self.fields.targets
+        self._stop_set = frozenset(self.stops)
+        self.matrix = [
+            [
+                0 if i == j else self._or_unreachable(self.fields.distance(self.stops[j], self.stops[i]))
+                for j in range(len(self.stops))
+            ]
+            for i in range(len(self.stops))
+        ]
+
+    @staticmethod
+    def _or_unreachable(distance):
+        return DistanceFields.UNREACHABLE if distance is None else distance
+
+    def __contains__(self, pos):
+        return pos in self._stop_set
+
+    def __iter__(self):
+        return iter(self.stops)
+
+    def _tour_cost(self, first_leg, tour):
+        cost = first_leg[tour[0]]
+        for a, b in zip(tour, tour[1:]):
+            cost += self.matrix[a][b]
+        return cost
+
+    def plan_tour(self, start, count, exclude=()):
+        """
+        Ordena las paradas a visitar desde start.
+
+        Construye el recorrido con vecino más cercano y lo mejora con 2-opt e intercambios con
+        las paradas que quedaron fuera, usando solo la matriz precalculada.
+
+        Args:
+            start (tuple): Posición de salida.
+            count (int): Número de paradas a visitar.
+            exclude (iterable): Paradas ya visitadas.
+
+        Returns:
+            list: Paradas en el orden en que conviene visitarlas.
+        """
+        unreachable = DistanceFields.UNREACHABLE
+        first_leg = [
+            unreachable if distance is None else distance
+            for distance in (self.fields.distance(stop, start) for stop in self.stops)
+        ]
+        exclude = set(exclude)
+        candidates = [
+            i for i, stop in enumerate(self.stops)
+            if stop not in exclude and first_leg[i] != unreachable
+        ]
+
+        # Vecino más cercano
+        tour = []
+        remaining = list(candidates)
+        while remaining and len(tour) < count:
+            if tour:
+                row = self.matrix[tour[-1]]
+                best = min(remaining, key=lambda i: row[i])
+                if row[best] == unreachable:
+                    break
+            else:
+                best = min(remaining, key=lambda i: first_leg[i])
+            tour.append(best)
+            remaining.remove(best)
+        if not tour:
+            return []
+
+        # 2-opt sobre el recorrido abierto e intercambio con paradas no usadas
+        best_cost = self._tour_cost(first_leg, tour)
+        improved = True
+        while improved:
+            improved = False
+            for i in range(len(tour) - 1):
+                for j in range(i + 1, len(tour)):
+                    candidate = tour[:i] + tour[i:j + 1][::-1] + tour[j + 1:]
+                    cost = self._tour_cost(first_leg, candidate)
+                    if cost < best_cost:
+                        tour, best_cost, improved = candidate, cost, True
+            for i in range(len(tour)):
+                for k, unused in enumerate(remaining):
+                    candidate = tour[:i] + [unused] + tour[i + 1:]
+                    cost = self._tour_cost(first_leg, candidate)
+                    if cost < best_cost:
+                        remaining[k] = tour[i]
+                        tour, best_cost, improved = candidate, cost, True
+
+        return [self.stops[i] for i in tour]
+
+
+class ObstacleLog:
+    """
+    Bitácora de celdas cuyo estado de obstáculo cambió, con posiciones absolutas.
+
+    Los lectores guardan hasta qué posición (end) ya aplicaron cambios. La bitácora se
+    compacta sola: descarta lo que ya vieron todos los planificadores vivos y, en todo
+    caso, nunca guarda más de HISTORY entradas; quien se quede más atrás debe recalcular.
+    """
+
+    COMPACT_AT = 1024
+    HISTORY = 4096
+
+    def __init__(self):
+        self.base = 0  # Posición absoluta de la primera entrada conservada
+        self.entries = []
+        self._readers = weakref.WeakSet()  # Planificadores vivos que leen la bitácora
+        self._limit = self.COMPACT_AT
+
+    @property
+    def end(self):
+        """Posición absoluta siguiente a la última entrada."""
+        return self.base + len(self.entries)
+
+    def append(self, pos):
+        self.entries.append(pos)
+        if len(self.entries) >= self._limit:
+            self.compact()
+
+    def register(self, reader):
+        """Registra un lector con atributo version; la compactación lo respeta mientras viva."""
+        self._readers.add(reader)
+
+    def since(self, version):
+        """Celdas cambiadas desde version, o None si esas entradas ya se descartaron."""
+        if version < self.base:
+            return None
+        return self.entries[version - self.base:]
+
+    def compact(self):
+        end = self.end
+        keep_from = min((reader.version for reader in self._readers), default=end)
+        keep_from = max(keep_from, end - self.HISTORY)
+        if keep_from > self.base:
+            del self.entries[:keep_from - self.base]
+            self.base = keep_from
+        self._limit = max(self.COMPACT_AT, 2 * len(self.entries))
+
+
+class IncrementalPlanner:
+    """
+    Planificador incremental D* Lite hacia un destino fijo.
+
+    Busca desde el destino hacia atrás y conserva sus valores g/rhs entre llamadas, así
+    cuando el vehículo avanza o una celda se bloquea/libera solo se reparan los nodos
+    afectados en lugar de repetir la búsqueda completa.
+    """
+
+    INF = float('inf')
+
+    def __init__(self, graph, goal, blocked=None, log=None):
+        self.graph = graph
+        self.goal_pos = goal
+        self.goal = graph.node(goal)
+        self.blocked = blocked  # Máscara (x, y) viva del modelo o None
+        self.log = log  # ObstacleLog del modelo o None
+        self._reset()
+        if log is not None:
+            log.register(self)
+
+    def _reset(self):
+        """Descarta el estado de búsqueda; la primera búsqueda ya ve la máscara actual."""
+        self.g = {}
+        self.rhs = {}
+        self.queue = []
+        self.queued = {}  # Nodo -> llave vigente en la cola
+        self.km = 0
+        self.last = None
+        self.start = None
+        self.version = self.log.end if self.log is not None else 0  # Hasta dónde se aplicó la bitácora
+        if self.goal is not None:
+            self.rhs[self.goal] = 0
+            self._push(self.goal, (self._h(self.goal), 0))
+
+    def _h(self, node):
+        """Heurística Manhattan entre el inicio actual y el nodo."""
+        if self.start is None:
+            return 0
+        a = self.graph.position(self.start)
+        b = self.graph.position(node)
+        return abs(a[0] - b[0]) + abs(a[1] - b[1])
+
+    def _key(self, node):
+        best = min(self.g.get(node, self.INF), self.rhs.get(node, self.INF))
+        return (best + self._h(node) + self.km, best)
+
+    def _push(self, node, key):
+        self.queued[node] = key
+        heapq.heappush(self.queue, (key, node))
+
+    def _cost(self, node, weight):
+        if self.blocked is not None and node != self.goal and self.blocked[self.graph.position(node)]:
+            return self.INF
+        return weight
+
+    def _update_vertex(self, node):
+        if node != self.goal:
+            self.rhs[node] = min(
+                (self._cost(neighbor, weight) + self.g.get(neighbor, self.INF)
+                 for neighbor, weight in self.graph.successors(node)),
+                default=self.INF,
+            )
+        self.queued.pop(node, None)
+        if self.g.get(node, self.INF) != self.rhs.get(node, self.INF):
+            self._push(node, self._key(node))
+
+    def _compute_shortest_path(self):
+        start = self.start
+        while self.queue:
+            old_key, node = self.queue[0]
+            if self.queued.get(node) != old_key:
+                heapq.heappop(self.queue)  # Entrada obsoleta
+                continue
+            if not (old_key < self._key(start) or self.rhs.get(start, self.INF) != self.g.get(start, self.INF)):
+                break
+            heapq.heappop(self.queue)
+            del self.queued[node]
+            new_key = self._key(node)
+            if old_key < new_key:
+                self._push(node, new_key)
+            elif self.g.get(node, self.INF) > self.rhs.get(node, self.INF):
+                self.g[node] = self.rhs[node]
+                for predecessor, _ in self.graph.predecessors(node):
+                    self._update_vertex(predecessor)
+            else:
+                self.g[node] = self.INF
+                self._update_vertex(node)
+                for predecessor, _ in self.graph.predecessors(node):
+                    self._update_vertex(predecessor)
+
+    def plan(self, start):
+        """
+        Repara el plan desde start aplicando los cambios de obstáculos aún no vistos.
+
+        Args:
+            start (tuple): Posición actual del vehículo.
+
+        Returns:
+            list: Posiciones desde start hasta el destino (ambas incluidas) o [] si no hay camino.
+        """
+        if start == self.goal_pos:
+            return [start]
+        node = self.graph.node(start)
+        if node is None or self.goal is None:
+            return []
+
+        changed = ()
+        if self.log is not None:
+            changed = self.log.since(self.version)
+            if changed is None:
+                self._reset()  # La bitácora ya se compactó más allá de lo aplicado
+                changed = ()
+            self.version = self.log.end
+        if self.start is None:
+            self.last = node
+        self.start = node
+        # El inicio se mueve en cada llamada, no solo cuando hay cambios: sin este ajuste las
+        # llaves de la cola dejan de ser cotas inferiores si el vehículo salió del plan anterior
+        self.km += self._h(self.last)
+        self.last = node
+        if changed:
+            for pos in set(changed):
+                changed_node = self.graph.node(pos)
+                if changed_node is None:
+                    continue
+                # Cambió el costo de las aristas que entran a la celda
+                for predecessor, _ in self.graph.predecessors(changed_node):
+                    self._update_vertex(predecessor)
+        self._compute_shortest_path()
+
+        if self.g.get(node, self.INF) == self.INF:
+            return []
+        path = [node]
+        while path[-1] != self.goal:
+            if len(path) > len(self.graph):
+                return []  # Ciclo: nunca se devuelve un camino que no llega al destino
+            step, weight = min(
+                self.graph.successors(path[-1]),
+                key=lambda edge: self._cost(edge[0], edge[1]) + self.g.get(edge[0], self.INF),
+            )
+            if self._cost(step, weight) + self.g.get(step, self.INF) == self.INF:
+                return []
+            path.append(step)
+        return [self.graph.position(step) for step in path]
+
+
+class RouteCache:
+    """
+    Caché LRU acotada de decisiones de ruta.
+
+    Las llaves incluyen las versiones del índice de estacionamientos y de la máscara de
+    obstáculos, así una entrada deja de usarse en cuanto cambia el estado del que depende.
+    Los contadores hits/misses sirven para dimensionarla según la flota.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_compute(self, key, compute):
+        """Devuelve el valor guardado para la llave o lo calcula con compute() y lo guarda."""
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        self.misses += 1
+        value = compute()
+        self._entries[key] = value
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)  # Descartar la entrada usada hace más tiempo
+        return value
+
+    def put(self, key, value):
+        """Guarda un valor calculado por fuera (por ejemplo en la planeación por lotes)."""
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def clear(self):
+        """Vacía la caché sin reiniciar los contadores."""
+        self._entries.clear()
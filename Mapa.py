@@ -1,27 +1,50 @@
-from mesa import Agent
+import numpy as np
 
-class Building(Agent):
-    def __init__(self, unique_id, model):
-        super().__init__(unique_id, model)
+# Tipos de celda de la capa estática del mapa (TrafficSimulation.cell_types)
+CELL_EMPTY = 0
+CELL_BUILDING = 1
+CELL_PARKING = 2
+CELL_LIGHT = 3
+CELL_ROUNDABOUT = 4
 
-class Parking(Agent):
-    def __init__(self, unique_id, model):
-        super().__init__(unique_id, model)
+# Los edificios no tienen objeto propio: son celdas CELL_BUILDING en la capa estática
+# y en la máscara de obstáculos del modelo.
+
+class Parking:
+    """Cajón de estacionamiento. Vive en la capa estática del modelo, no en el grid ni en el activador."""
+    __slots__ = ("model", "pos", "is_occupied")
+
+    def __init__(self, model, pos):
+        self.model = model
+        self.pos = pos
         self.is_occupied = False  # Estado inicial del estacionamiento
 
     def occupy(self):
-        """Marca el espacio como ocupado."""
-        self.is_occupied = True
+        """Marca el espacio como ocupado, lo saca del índice de libres y lo bloquea en la máscara."""
+        if not self.is_occupied:
+            self.is_occupied = True
+            self.model.free_parkings.discard(self.pos)
+            self.model.parking_version += 1
+            self.model.set_obstacle(self.pos, True)  # El vehículo estacionado bloquea la celda
 
     def vacate(self):
-        """Marca el espacio como desocupado."""
-        self.is_occupied = False
+        """Marca el espacio como desocupado, lo regresa al índice de libres y lo libera en la máscara."""
+        if self.is_occupied:
+            self.is_occupied = False
+            self.model.free_parkings.add(self.pos)
+            self.model.parking_version += 1
+            self.model.set_obstacle(self.pos, False)
 
-class Roundabout(Agent):
-    def __init__(self, unique_id, model):
-        super().__init__(unique_id, model)
+class Roundabout:
+    """Celda de glorieta; solo guarda su posición."""
+    __slots__ = ("pos",)
+
+    def __init__(self, pos):
+        self.pos = pos
 
 class Lane:
+    __slots__ = ("positions", "direction")
+
     def __init__(self, positions, direction):
-        self.positions = positions
+        self.positions = np.asarray(positions, dtype=np.int32).reshape(-1, 2)  # Celdas empacadas (K, 2)
         self.direction = direction
@@ -1,7 +1,5 @@
 from mesa import Agent
-import heapq
-from Mapa import Parking
-from Negotiation import Negotiation
+from Grafo import IncrementalPlanner
 import time
 
 class Microbus(Agent):
@@ -18,7 +16,9 @@ class Microbus(Agent):
         self.max_passengers = 5  # Capacidad máxima de pasajeros
         self.collecting_passengers = True
         self.visited_stops = set()  # Estado de recolección de pasajeros
+        self.tour = None  # Orden de paradas planeado una sola vez con la matriz del modelo
         self.blocked_steps = 0  # Contador de pasos bloqueados
+        self.planner = None  # Estado de D* Lite hacia el destino actual
         self.last_attempt_time = time.time()  # Tiempo del último intento de moverse
 
     def step(self):
@@ -31,14 +31,8 @@ class Microbus(Agent):
         # Imprimir estado actual
         print(f"Microbús {self.unique_id}: Estado actual - {self.state}")
 
-        # Verificar si hay otros microbuses cercanos para negociar
-        neighbors = self.model.grid.get_neighbors(self.pos, moore=False, radius=1)
-        vehicles_nearby = [agent for agent in neighbors if isinstance(agent, Microbus) and not agent.parked]
-
-        for other_vehicle in vehicles_nearby:
-            # Realizar negociación si hay un conflicto
-            action_self, action_other = Negotiation.negotiate(self, other_vehicle)
-
+        # Reaccionar a las negociaciones que el modelo resolvió en este paso
+        for other_vehicle, action_self, action_other in self.model.negotiations.get(self, ()):
             # Resolver conflicto según el resultado de la negociación
             if action_self == "cede" and action_other == "compite":
                 print(f"Microbús {self.unique_id} cede el paso al microbús {other_vehicle.unique_id}.")
@@ -51,15 +45,12 @@ class Microbus(Agent):
                 return
             elif action_self == "compite" and action_other == "compite":
                 print(f"Microbús {self.unique_id} y {other_vehicle.unique_id} están bloqueados. Buscando alternativas.")
-                self.happiness -= 5  # Penalización por competencia inútil
-                other_vehicle.happiness -= 5
                 self.blocked_steps += 1
-                other_vehicle.blocked_steps += 1
 
                 # Si el microbús está bloqueado durante más de 3 pasos, recalcula la ruta
                 if self.blocked_steps > 3:
                     print(f"Microbús {self.unique_id}: Recalculando ruta debido a bloqueo prolongado.")
-                    self._calculate_path()
+                    self._replan()
                     self.blocked_steps = 0
 
         # Solicitar semáforo si se acerca a uno
@@ -74,11 +65,7 @@ class Microbus(Agent):
 
     def _approaching_light(self):
         """Verifica si el microbús se acerca a un semáforo"""
-        from Semaforo import TrafficLight
-        for agent in self.model.grid.get_neighbors(self.pos, moore=False, radius=2):
-            if isinstance(agent, TrafficLight):
-                return True
-        return False
+        return bool(self.model.lights_near(self.pos))
 
     def _update_state(self):
         """Actualiza el estado emocional del microbús según su felicidad."""
@@ -87,103 +74,79 @@ class Microbus(Agent):
         elif self.happiness >= 50 and self.state != "NORMAL":
             self.state = "NORMAL"
 
-    def _calculate_path(self):
-        """Calcula el camino más corto a una parada o un estacionamiento usando A*."""
-        # Definimos los carriles con sus coordenadas y direcciones
-        lanes_positions = self.model.get_lanes_positions()
-
-        # Creamos el grafo dirigido a partir de las posiciones de los carriles
-        graph = {}
-        for lane, direction in lanes_positions:
-            for i in range(len(lane) - 1):
-                if direction == "right_to_left":
-                    graph.setdefault(lane[i], []).append((lane[i+1], 1))
-                elif direction == "left_to_right":
-                    graph.setdefault(lane[i], []).append((lane[i+1], 1))
-                elif direction == "down":
-                    graph.setdefault(lane[i], []).append((lane[i+1], 1))
-                elif direction == "up":
-                    graph.setdefault(lane[i], []).append((lane[i+1], 1))
+    def negotiation_request(self):
+        """Clases de vehículos con las que negociaría en este paso; la usa la fase de conflictos del modelo."""
+        if self.parked:
+            return None
+        return Microbus
 
+    def route_request(self):
+        """Política de ruta que pedirá en este paso; la usa la planeación por lotes del modelo."""
+        if not self.parked and not self.collecting_passengers and (not self.path or self.pos == self.target):
+            return "nearest"
+        return None
+
+    def _calculate_path(self):
+        """Calcula la ruta a la siguiente parada del recorrido o al estacionamiento más cercano."""
         start = self.pos
         if self.collecting_passengers:
-            stops = [
-                (21, 16), (22, 2), (21, 23), (22, 8),
-                (12, 23), (12, 19), (2, 3), (3, 13), (9, 13), (7, 12)
-            ]
-            target_points = [stop for stop in stops if stop not in self.visited_stops]
-        else:
-            parkings = [
-                agent.pos
-                for content, pos in self.model.grid.coord_iter()
-                for agent in content
-                if isinstance(agent, Parking) and not agent.is_occupied
-            ]
-            target_points = parkings
-
-        if not target_points:
-            print(f"Microbús {self.unique_id}: No hay destinos disponibles.")
-            self.path = None
-            return
+            registry = self.model.stop_registry
+            if not self.tour:
+                # Se planea todo el recorrido de recolección de una vez
+                pending = self.max_passengers - self.passengers
+                self.tour = registry.plan_tour(start, pending, exclude=self.visited_stops)
+            while self.tour and self.tour[0] in self.visited_stops:
+                self.tour.pop(0)
+
+            if not self.tour:
+                print(f"Microbús {self.unique_id}: No hay destinos disponibles.")
+                self.path = None
+                return
 
-        closest_target = None
-        shortest_path = None
-        shortest_distance = float('inf')
+            # La ruta de cada tramo sale de las tablas de siguiente salto de la parada
+            self.target = self.tour[0]
+            self.path = registry.fields.route(start, self.target)
+            if not self.path:
+                self.tour = None  # Quedó fuera del recorrido, se vuelve a planear
+        else:
+            # Índice de estacionamientos libres que mantiene el modelo
+            parkings = self.model.free_parkings
+            if not parkings:
+                print(f"Microbús {self.unique_id}: No hay destinos disponibles.")
+                self.path = None
+                return
 
-        for target in target_points:
-            path = self._a_star(graph, start, target)
-            if path and len(path) < shortest_distance:
-                closest_target = target
-                shortest_path = path
-                shortest_distance = len(path)
+            # Los estacionamientos tienen campos de distancia precalculados, no hace falta buscar
+            fields = self.model.parking_fields
+            self.target = self.model.cached_route(start, "nearest", lambda: fields.nearest(start, parkings))
+            self.path = fields.route(start, self.target) if self.target is not None else None
 
-        if closest_target and shortest_path:
-            self.target = closest_target
-            self.path = shortest_path
-        else:
+        if not self.path:
             print(f"Microbús {self.unique_id}: No hay camino al destino.")
             self.path = None
 
-    def _a_star(self, graph, start, goal):
-        # Algoritmo A* para encontrar la ruta más corta
-        open_set = [(0, start)]
-        g_costs = {start: 0}
-        f_costs = {start: self._heuristic(start, goal)}
-        previous_nodes = {start: None}
-
-        while open_set:
-            _, current_node = heapq.heappop(open_set)
-
-            if current_node == goal:
-                path = []
-                while previous_nodes[current_node] is not None:
-                    path.append(current_node)
-                    current_node = previous_nodes[current_node]
-                path.append(start)
-                return path[::-1]
-
-            for neighbor, weight in graph.get(current_node, []):
-                g_cost = g_costs[current_node] + weight
-                if neighbor not in g_costs or g_cost < g_costs[neighbor]:
-                    g_costs[neighbor] = g_cost
-                    f_cost = g_cost + self._heuristic(neighbor, goal)
-                    f_costs[neighbor] = f_cost
-                    heapq.heappush(open_set, (f_cost, neighbor))
-                    previous_nodes[neighbor] = current_node
-
-        return []
-
-    def _heuristic(self, node, goal):
-        # Heurística de Manhattan para el cálculo de A*
-        return abs(node[0] - goal[0]) + abs(node[1] - goal[1])
+    def _replan(self):
+        """Repara la ruta al destino actual con D* Lite en lugar de buscar desde cero."""
+        target_taken = not self.collecting_passengers and self.target not in self.model.free_parkings
+        if self.target is None or target_taken:
+            self._calculate_path()
+            return
+
+        if self.planner is None or self.planner.goal_pos != self.target:
+            self.planner = IncrementalPlanner(self.model.road_graph, self.target, self.model.obstacles, self.model.obstacle_log)
+        self.path = self.planner.plan(self.pos)
+        if not self.path:
+            self._calculate_path()
 
     def move(self):
         """Mueve el microbús al siguiente paso en el camino calculado."""
+        if self.path and self.path[0] == self.pos:
+            self.path.pop(0)  # Las rutas incluyen la celda actual
         if self.path:
             next_position = self.path[0]
 
             # Verificar si el próximo espacio es una parada de recogida de pasajeros
-            if self.collecting_passengers and next_position in set([(21, 16), (22, 2), (21, 23), (22, 8), (12, 23), (12, 19), (2, 3), (3, 13), (9, 13), (7, 12)]) and next_position not in getattr(self, 'visited_stops', set()):
+            if self.collecting_passengers and next_position in self.model.stop_registry and next_position not in self.visited_stops:
                 self.passengers += 1
                 self.visited_stops.add(next_position)  # Sumar un pasajero al llegar a una parada
                 if self.passengers >= self.max_passengers:
@@ -193,8 +156,7 @@ class Microbus(Agent):
             # Verificar si el próximo espacio es un estacionamiento
             if not self.collecting_passengers and next_position == self.target:
                 # Obtener el contenido de la celda del estacionamiento
-                parking_spot = self.model.grid.get_cell_list_contents([next_position])
-                parking_agent = next((agent for agent in parking_spot if isinstance(agent, Parking)), None)
+                parking_agent = self.model.parkings.get(next_position)
 
                 if parking_agent and parking_agent.is_occupied:
                     self._calculate_path()  # Recalcular la ruta hacia otro estacionamiento
@@ -205,14 +167,13 @@ class Microbus(Agent):
                     parking_agent.occupy()
 
                 print(f"Microbús {self.unique_id}: Se ha estacionado en {next_position}.")
-                self.model.grid.move_agent(self, next_position)
-                self.parked = True  # Marcar el microbús como estacionado
+                self.model.move_vehicle(self, next_position)
+                self.model.park(self)  # Marcar el microbús como estacionado
                 return  # Detenerse aquí al llegar al estacionamiento
 
             # Si no es un estacionamiento, mover hacia la siguiente posición
-            from Semaforo import TrafficLight
-            if self.model.grid.is_cell_empty(next_position) or any(isinstance(agent, TrafficLight) for agent in self.model.grid.get_cell_list_contents([next_position])):
-                self.model.grid.move_agent(self, next_position)
+            if self.model.can_enter(next_position):
+                self.model.move_vehicle(self, next_position)
                 self.path.pop(0)
             else:
                 # Si está bloqueado por un obstáculo no permitido
@@ -228,6 +189,6 @@ class Microbus(Agent):
         neighbors = self.model.grid.get_neighborhood(self.pos, moore=False, include_center=False)
 
         for neighbor in neighbors:
-            if self.model.grid.is_cell_empty(neighbor) and neighbor[0] > 0 and neighbor[1] > 0:
-                self.model.grid.move_agent(self, neighbor)
+            if self.model.is_free(neighbor) and neighbor[0] > 0 and neighbor[1] > 0:
+                self.model.move_vehicle(self, neighbor)
                 return
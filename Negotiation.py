@@ -1,5 +1,6 @@
 # ------------------------ Nuestra negociacion ----------------
 import random
+import numpy as np
 
 class Negotiation:
     """Clase para manejar la negociación entre dos vehículos basada en la teoría de juegos."""
@@ -11,6 +12,9 @@ class Negotiation:
         ("compite", "compite"): (0, 0),
     }
 
+    actions = ("cede", "compite")
+    penalty = 5  # Penalización por competencia inútil cuando ambos compiten
+
     @staticmethod
     def negotiate(vehicle_a, vehicle_b):
         """
@@ -38,3 +42,40 @@ class Negotiation:
               f"Recompensas -> A: {reward_a}, B: {reward_b}")
 
         return choice_a, choice_b
+
+    @staticmethod
+    def resolve(pairs, rng):
+        """
+        Resuelve de una sola vez todas las negociaciones del paso.
+
+        Cada pareja se negocia una sola vez: las estrategias se sortean juntas con el
+        generador de NumPy y las recompensas se leen de la matriz de pagos de forma
+        vectorizada. La felicidad de ambos vehículos se actualiza aquí, incluida la
+        penalización cuando los dos compiten.
+
+        Args:
+            pairs (list): Parejas (vehicle_a, vehicle_b) en conflicto.
+            rng (numpy.random.Generator): Generador para elegir las estrategias.
+
+        Returns:
+            list: Acciones (choice_a, choice_b) de cada pareja, en el mismo orden.
+        """
+        if not pairs:
+            return []
+
+        actions = Negotiation.actions
+        rewards = np.array([[Negotiation.payoff_matrix[(a, b)] for b in actions] for a in actions])
+        choices = rng.integers(0, len(actions), size=(len(pairs), 2))
+        gains = rewards[choices[:, 0], choices[:, 1]]
+        both_compete = (choices[:, 0] == 1) & (choices[:, 1] == 1)
+        gains -= Negotiation.penalty * both_compete[:, None]
+
+        outcomes = []
+        for (vehicle_a, vehicle_b), (gain_a, gain_b), (index_a, index_b) in zip(pairs, gains.tolist(), choices.tolist()):
+            choice_a, choice_b = actions[index_a], actions[index_b]
+            vehicle_a.happiness += gain_a
+            vehicle_b.happiness += gain_b
+            print(f"Vehículo {vehicle_a.unique_id} ({choice_a}) vs Vehículo {vehicle_b.unique_id} ({choice_b}): "
+                  f"Recompensas -> A: {gain_a}, B: {gain_b}")
+            outcomes.append((choice_a, choice_b))
+        return outcomes
@@ -28,8 +28,8 @@ class TrafficLight(Agent):
     def _process_vehicle_requests(self):
         """Procesa las solicitudes de los vehículos cercanos."""
         requesting_vehicles = [
-            agent for agent in self.model.schedule.agents
-            if isinstance(agent, Vehicle) and agent.request_light
+            agent for agent in self.model.vehicles.get(Vehicle, [])
+            if agent.request_light
         ]
 
         # Procesar vehículos cercanos al semáforo (distancia <= 2)
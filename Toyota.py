@@ -1,8 +1,6 @@
 from mesa import Agent
-import heapq
-from Mapa import Parking, Building, Lane
-from Negotiation import Negotiation
-from Semaforo import TrafficLight
+from Mapa import CELL_BUILDING
+from Grafo import IncrementalPlanner
 from Ferrari import Vehicle  # Asegúrate de que esta clase exista o ajústala según tu modelo
 
 class Toyota(Agent):
@@ -16,6 +14,7 @@ class Toyota(Agent):
         self.light_granted = False   # Indica si el semáforo le otorgó paso
         self.parked = False          # Indica si está estacionado
         self.blocked_counter = 0     # Contador para detectar bloqueos
+        self.planner = None          # Estado de D* Lite hacia el objetivo actual
 
     def step(self):
         if self.parked:
@@ -25,15 +24,8 @@ class Toyota(Agent):
         # Actualizar estado y felicidad
         self._update_state()
 
-        # Verificar si hay otros vehículos cercanos para negociar
-        neighbors = self.model.grid.get_neighbors(self.pos, moore=False, radius=1)
-        vehicle_classes = (Toyota, Vehicle)  # Asegúrate de incluir todas las clases de vehículos relevantes
-        vehicles_nearby = [agent for agent in neighbors if isinstance(agent, vehicle_classes) and not agent.parked]
-
-        for other_vehicle in vehicles_nearby:
-            # Realizar negociación si hay un conflicto
-            action_self, action_other = Negotiation.negotiate(self, other_vehicle)
-
+        # Reaccionar a las negociaciones que el modelo resolvió en este paso
+        for other_vehicle, action_self, action_other in self.model.negotiations.get(self, ()):
             # Resolver conflicto según el resultado de la negociación
             if action_self == "cede" and action_other == "compite":
                 print(f"Toyota {self.unique_id} cede el paso al vehículo {other_vehicle.unique_id}.")
@@ -46,12 +38,9 @@ class Toyota(Agent):
                 continue  # Ambos cooperan, seguir intentando moverse
             elif action_self == "compite" and action_other == "compite":
                 print(f"Toyota {self.unique_id} y {other_vehicle.unique_id} están bloqueados. Buscando alternativas.")
-                self.happiness -= 5  # Penalización por competencia inútil
-                if hasattr(other_vehicle, 'happiness'):
-                    other_vehicle.happiness -= 5
                 self.blocked_counter += 1
                 if self.blocked_counter > 3:
-                    self._calculate_path()  # Recalcular ruta si está bloqueado muchas veces
+                    self._replan()  # Reparar la ruta si está bloqueado muchas veces
                     self.blocked_counter = 0
                 continue
 
@@ -77,18 +66,17 @@ class Toyota(Agent):
 
     def _approaching_light(self):
         """Verifica si el Toyota se acerca a un semáforo."""
-        for agent in self.model.grid.get_neighbors(self.pos, moore=False, radius=2):
-            if isinstance(agent, TrafficLight):
-                # Verificar el estado del semáforo
-                if agent.state == "RED":
-                    print(f"Toyota {self.unique_id}: Se detiene en semáforo rojo en {agent.pos}.")
-                    return True
-                elif agent.state == "GREEN":
-                    print(f"Toyota {self.unique_id}: Semáforo en verde en {agent.pos}. Puede avanzar.")
-                    self.light_granted = True
-                elif agent.state == "YELLOW":
-                    print(f"Toyota {self.unique_id}: Semáforo en amarillo en {agent.pos}. Preparándose para detenerse.")
-                    self.light_granted = False
+        for agent in self.model.lights_near(self.pos):
+            # Verificar el estado del semáforo
+            if agent.state == "RED":
+                print(f"Toyota {self.unique_id}: Se detiene en semáforo rojo en {agent.pos}.")
+                return True
+            elif agent.state == "GREEN":
+                print(f"Toyota {self.unique_id}: Semáforo en verde en {agent.pos}. Puede avanzar.")
+                self.light_granted = True
+            elif agent.state == "YELLOW":
+                print(f"Toyota {self.unique_id}: Semáforo en amarillo en {agent.pos}. Preparándose para detenerse.")
+                self.light_granted = False
         return False
 
     def _attempt_lane_change(self):
@@ -102,8 +90,8 @@ class Toyota(Agent):
         dy = next_position[1] - self.pos[1]
         front_position = (self.pos[0] + dx, self.pos[1] + dy)
 
-        for agent in self.model.grid.get_cell_list_contents(front_position):
-            if isinstance(agent, (Toyota, Vehicle)) and not agent.parked:
+        for agent in self.model.moving_vehicles.get(front_position, ()):
+            if isinstance(agent, (Toyota, Vehicle)):
                 # Detecta un vehículo bloqueando, intenta cambiar de carril
                 lane_change_candidates = [
                     (self.pos[0] + dy, self.pos[1] - dx),  # Desplazamiento perpendicular a la derecha
@@ -112,8 +100,8 @@ class Toyota(Agent):
                 for candidate in lane_change_candidates:
                     # Verificar límites del grid y si la celda está vacía
                     if (0 <= candidate[0] < self.model.grid.width and 0 <= candidate[1] < self.model.grid.height
-                            and self.model.grid.is_cell_empty(candidate)):
-                        self.model.grid.move_agent(self, candidate)
+                            and self.model.is_free(candidate)):
+                        self.model.move_vehicle(self, candidate)
                         print(f"Toyota {self.unique_id}: Cambió de carril a {candidate}.")
                         return True
                 print(f"Toyota {self.unique_id}: No pudo cambiar de carril, sigue bloqueado.")
@@ -129,8 +117,7 @@ class Toyota(Agent):
 
         # Verificar si el próximo movimiento es el objetivo y si el estacionamiento está disponible
         if next_position == self.target:
-            cell_contents = self.model.grid.get_cell_list_contents([next_position])
-            parking_agent = next((agent for agent in cell_contents if isinstance(agent, Parking)), None)
+            parking_agent = self.model.parkings.get(next_position)
 
             if parking_agent and parking_agent.is_occupied:
                 print(f"Toyota {self.unique_id}: Estacionamiento en {next_position} está ocupado. Recalculando ruta.")
@@ -140,117 +127,90 @@ class Toyota(Agent):
             if parking_agent:
                 parking_agent.occupy()
 
-            self.model.grid.move_agent(self, next_position)
-            self.parked = True
+            self.model.move_vehicle(self, next_position)
+            self.model.park(self)
             print(f"Toyota {self.unique_id}: Se ha estacionado en {next_position}.")
             return
 
         # Verificar si el siguiente espacio está ocupado por un edificio u obstáculo fijo
-        cell_contents = self.model.grid.get_cell_list_contents([next_position])
-        if any(isinstance(agent, Building) for agent in cell_contents):
+        if self.model.cell_types[next_position] == CELL_BUILDING:
             print(f"Toyota {self.unique_id}: No puede pasar por un edificio en {next_position}. Recalculando ruta.")
-            self._calculate_path()
+            self._replan()
             return
 
         # Mover hacia la siguiente posición si está libre
-        if self.model.grid.is_cell_empty(next_position):
-            self.model.grid.move_agent(self, next_position)
+        if self.model.is_free(next_position):
+            self.model.move_vehicle(self, next_position)
         else:
             # Si está bloqueado por un obstáculo temporal
             self.happiness -= 10
             if self.state == "ENOJADO":
                 self._attempt_lane_change()
 
-    def _calculate_path(self):
-        """Calcula el camino más largo a un estacionamiento disponible usando A* evitando celdas ocupadas."""
-        # Obtener las posiciones de los carriles y direcciones
-        lanes_positions = self.model.get_lanes_positions()
+    def negotiation_request(self):
+        """Clases de vehículos con las que negociaría en este paso; la usa la fase de conflictos del modelo."""
+        if self.parked:
+            return None
+        return (Toyota, Vehicle)
 
-        # Crear el grafo dirigido a partir de las posiciones de los carriles
-        graph = {}
-        for lane, direction in lanes_positions:
-            for i in range(len(lane) - 1):
-                graph.setdefault(lane[i], []).append((lane[i+1], 1))
+    def route_request(self):
+        """Política de ruta que pedirá en este paso; la usa la planeación por lotes del modelo."""
+        if not self.parked and (not self.path or self.pos == self.target):
+            return "farthest"
+        return None
 
+    def _calculate_path(self):
+        """Calcula el camino más largo a un estacionamiento disponible evitando celdas ocupadas."""
         start = self.pos
 
-        # Buscar los estacionamientos disponibles
-        parkings = [
-            agent.pos
-            for content, pos in self.model.grid.coord_iter()
-            for agent in content
-            if isinstance(agent, Parking) and not agent.is_occupied
-        ]
+        # Índice de estacionamientos libres que mantiene el modelo
+        parkings = self.model.free_parkings
 
         if not parkings:
             print(f"Toyota {self.unique_id}: No hay estacionamientos disponibles.")
             self.path = None
             return
 
-        paths = []
-        for target in parkings:
-            path = self._a_star(graph, start, target)
-            if path:
-                paths.append((len(path), path, target))
-
-        if paths:
-            # Seleccionar el camino más largo (estacionamiento más lejano)
-            paths.sort(key=lambda x: x[0], reverse=True)
-            longest_path = paths[0][1]
-            farthest_target = paths[0][2]
+        # Una sola búsqueda sobre los tramos con la máscara de obstáculos, compartida con otros Toyota en la misma celda
+        farthest_target, longest_path = self.model.cached_route(
+            start, "farthest", lambda: self._farthest_route(start, parkings))
+
+        if farthest_target is not None:
             print(f"Toyota {self.unique_id}: Calculó ruta al estacionamiento más lejano en {farthest_target}")
             self.target = farthest_target
-            self.path = longest_path
+            self.path = longest_path.copy()  # Route perezosa, se expande conforme avanza
         else:
             print(f"Toyota {self.unique_id}: No hay camino disponible a ningún estacionamiento.")
             self.path = None
 
-    def _a_star(self, graph, start, goal):
-        # Algoritmo A* para encontrar la ruta más corta evitando celdas ocupadas
-        open_set = [(0, start)]
-        g_costs = {start: 0}
-        previous_nodes = {start: None}
-        closed_set = set()
-
-        while open_set:
-            _, current_node = heapq.heappop(open_set)
-
-            if current_node == goal:
-                path = []
-                while current_node is not None:
-                    path.append(current_node)
-                    current_node = previous_nodes[current_node]
-                return path[::-1]
-
-            closed_set.add(current_node)
-
-            for neighbor, weight in graph.get(current_node, []):
-                if neighbor in closed_set:
-                    continue
-
-                # Verificar si la celda está ocupada por un obstáculo fijo (Building) o vehículo estacionado
-                cell_contents = self.model.grid.get_cell_list_contents([neighbor])
-                cell_occupied = any(
-                    isinstance(agent, Building) or
-                    (hasattr(agent, 'parked') and agent.parked and agent != self)
-                    for agent in cell_contents
-                )
-
-                if cell_occupied and neighbor != goal:
-                    continue  # Saltar celdas ocupadas, excepto si es el objetivo
-
-                tentative_g_cost = g_costs[current_node] + weight
-                if neighbor not in g_costs or tentative_g_cost < g_costs[neighbor]:
-                    previous_nodes[neighbor] = current_node
-                    g_costs[neighbor] = tentative_g_cost
-                    f_cost = tentative_g_cost + self._heuristic(neighbor, goal)
-                    heapq.heappush(open_set, (f_cost, neighbor))
-
-        return []
-
-    def _heuristic(self, node, goal):
-        """Heurística de distancia de Manhattan."""
-        return abs(node[0] - goal[0]) + abs(node[1] - goal[1])
+    def _replan(self):
+        """Repara la ruta al objetivo actual con D* Lite; si el objetivo ya se ocupó busca otro."""
+        if self.target not in self.model.free_parkings:
+            self._calculate_path()
+            return
+
+        if self.planner is None or self.planner.goal_pos != self.target:
+            self.planner = IncrementalPlanner(self.model.road_graph, self.target, self.model.obstacles, self.model.obstacle_log)
+        self.path = self.planner.plan(self.pos)
+        if not self.path:
+            self._calculate_path()
+
+    def _farthest_route(self, start, parkings):
+        """Devuelve (estacionamiento más lejano, ruta) con una sola búsqueda sobre el grafo de tramos."""
+        graph = self.model.road_graph
+        segments = self.model.segment_graph
+        distances, previous = segments.search(start, parkings, self.model.obstacles, self.model.obstacle_log)
+        reachable = [
+            (distances[graph.node(target)], target)
+            for target in sorted(parkings)
+            if graph.node(target) in distances
+        ]
+        if not reachable:
+            return None, None
+
+        # Seleccionar el estacionamiento más lejano (en empate, el de menor coordenada)
+        _, farthest_target = max(reachable, key=lambda x: x[0])
+        return farthest_target, segments.route(previous, graph.node(farthest_target))
 
     def _update_state(self):
         """Actualiza el estado emocional del Toyota según su felicidad."""
@@ -1,18 +1,334 @@
-from flask import Flask, jsonify, request
+import bisect
+import gzip
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from operator import itemgetter
+
+import numpy as np
+from flask import Flask, Response, jsonify, request
 from mesa.visualization.modules import CanvasGrid
 from Ferrari_model import TrafficSimulation
-from Ferrari import Vehicle
-from Microbus import Microbus
-from Jeep import Jeeps
-from Toyota import Toyota
-from Moto import Moto
-from Semaforo import TrafficLight
 
 app = Flask(__name__)
 
 # Inicializa la simulación con parámetros deseados
 simulation = TrafficSimulation(width=25, height=25, num_vehicles=4, num_microbus=4, num_moto=4, num_jeeps=4, num_toyota=4)
 
+# Pasos de simulación por segundo del hilo de fondo (configurable por entorno)
+TICK_RATE = float(os.environ.get("SIM_TICK_RATE", "2"))
+
+
+class Snapshot:
+    """
+    Fotografía inmutable del estado de la simulación en un paso.
+    Los endpoints sólo leen snapshots; nunca tocan el modelo.
+
+    vehicles trae un registro por vehículo con el tick de su último cambio
+    (changed_at), ordenados por ese tick; removed trae pares (id, removed_at) de los vehículos que
+    salieron del modelo. Los deltas son completos sólo desde horizon.
+    rows trae los mismos vehículos como arreglo RECORD_DTYPE, listo para el formato binario.
+    """
+    __slots__ = ("tick", "vehicles", "lights", "removed", "horizon", "rows")
+
+    def __init__(self, tick, vehicles, lights, removed=(), horizon=0, rows=None):
+        object.__setattr__(self, "tick", tick)
+        object.__setattr__(self, "vehicles", vehicles)
+        object.__setattr__(self, "lights", lights)
+        object.__setattr__(self, "removed", removed)
+        object.__setattr__(self, "horizon", horizon)
+        object.__setattr__(self, "rows", np.empty(0, dtype=RECORD_DTYPE) if rows is None else rows)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshot es inmutable")
+
+    def vehicles_since(self, since):
+        """
+        Vehículos que se movieron, aparecieron o cambiaron de estacionado
+        después de since, y ids de los que desaparecieron.
+        """
+        first = bisect.bisect_right(self.vehicles, since, key=itemgetter("changed_at"))
+        first_removed = bisect.bisect_right(self.removed, since, key=itemgetter(1))
+        return self.vehicles[first:], [vehicle_id for vehicle_id, _ in self.removed[first_removed:]]
+
+
+class SnapshotBuffer:
+    """
+    Doble búfer de snapshots: el hilo de simulación construye el siguiente
+    snapshot fuera del candado y sólo intercambia el búfer frontal al publicar.
+    Los lectores obtienen siempre un snapshot completo, sin esperar a un paso.
+    """
+
+    def __init__(self, initial):
+        self._published = threading.Condition()
+        self._buffers = [initial, initial]
+        self._front = 0
+
+    def publish(self, snapshot):
+        back = 1 - self._front
+        self._buffers[back] = snapshot
+        with self._published:
+            self._front = back
+            self._published.notify_all()
+
+    def latest(self):
+        with self._published:
+            return self._buffers[self._front]
+
+    def wait_newer(self, tick, timeout=None):
+        """
+        Espera a que haya un snapshot posterior a tick y devuelve el más
+        reciente; los intermedios se descartan. Devuelve None si vence timeout.
+        """
+        with self._published:
+            if not self._published.wait_for(lambda: self._buffers[self._front].tick > tick, timeout):
+                return None
+            return self._buffers[self._front]
+
+
+# Formato binario: cabecera fija seguida de registros de tamaño fijo, todo
+# little-endian. El cliente puede leerlo directamente sin parsear.
+#   cabecera: magic b"TSIM", versión (u2), tamaño de registro (u2), tick (u4),
+#             número de vehículos (u4), número de semáforos (u4)
+#   registro: id (u4), x (i2), z (i2), tipo (u1), estado (u1), estacionado (u1), relleno (u1)
+BINARY_MIMETYPE = "application/octet-stream"
+BINARY_MAGIC = b"TSIM"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<4sHHIII")
+RECORD_DTYPE = np.dtype([
+    ("id", "<u4"),
+    ("x", "<i2"),
+    ("z", "<i2"),
+    ("type", "u1"),
+    ("state", "u1"),
+    ("parked", "u1"),
+    ("pad", "u1"),
+])
+TYPE_CODES = {"Vehicle": 1, "Microbus": 2, "Moto": 3, "Jeeps": 4, "Toyota": 5, "TrafficLight": 6}
+# Los estados de ánimo en español del Toyota comparten código con sus equivalentes
+STATE_CODES = {"NORMAL": 0, "HAPPY": 1, "FELIZ": 1, "ANGRY": 2, "ENOJADO": 2,
+               "GREEN": 3, "YELLOW": 4, "RED": 5}
+UNKNOWN_CODE = 255
+
+
+# Ticks de historial de bajas que se conservan para responder deltas
+REMOVED_HISTORY = 1000
+
+
+class VehicleFeed:
+    """
+    Sigue los cambios de los vehículos entre pasos (posición, estacionado o
+    estado de ánimo) para estampar cada registro con el tick de su último
+    cambio. Los registros sin cambios se reutilizan tal cual, así que un
+    vehículo estacionado no genera basura. Los registros se mantienen
+    ordenados por changed_at para que los deltas se busquen por bisección.
+    En paralelo se lleva un arreglo RECORD_DTYPE con una fila por vehículo que
+    se escribe al estampar cada cambio, así el formato binario sale de una
+    copia del arreglo sin recorrer los registros.
+    Sólo lo usa el hilo que avanza la simulación.
+    """
+
+    def __init__(self):
+        self._records = OrderedDict()  # id -> registro más reciente, por tick de cambio
+        self._removed = []  # (id, tick de baja), en orden de tick
+        self._rows = np.zeros(64, dtype=RECORD_DTYPE)  # Filas binarias; las primeras len(_slots) son válidas
+        self._slots = {}  # id -> fila en _rows
+        self._frozen = None  # Copia de las filas válidas para los snapshots; None si cambiaron
+
+    def update(self, tick):
+        records = self._records
+        alive = set()
+        for agent in simulation.all_vehicles():  # Registro de vehículos del modelo, sin recorrer el activador
+            vehicle_id = agent.unique_id
+            alive.add(vehicle_id)
+            x, z = agent.pos
+            previous = records.get(vehicle_id)
+            if (previous is not None and previous["x"] == x and previous["z"] == z
+                    and previous["parked"] == agent.parked and previous["state"] == agent.state):
+                continue
+            record = records[vehicle_id] = {
+                "id": vehicle_id,
+                "type": type(agent).__name__,
+                "x": x,
+                "z": z,
+                "parked": agent.parked,
+                "state": agent.state,
+                "changed_at": tick,
+            }
+            records.move_to_end(vehicle_id)  # Los cambiados pasan al final
+            self._stamp_row(record)
+        for vehicle_id in records.keys() - alive:
+            del records[vehicle_id]
+            self._drop_row(vehicle_id)
+            self._removed.append((vehicle_id, tick))
+
+        horizon = max(0, tick - REMOVED_HISTORY)
+        if self._removed and self._removed[0][1] <= horizon:
+            self._removed = [entry for entry in self._removed if entry[1] > horizon]
+        if self._frozen is None:
+            self._frozen = self._rows[:len(self._slots)].copy()  # Los snapshots nunca ven escrituras
+        return tuple(records.values()), tuple(self._removed), horizon, self._frozen
+
+    def _stamp_row(self, record):
+        self._frozen = None
+        slot = self._slots.get(record["id"])
+        if slot is None:
+            slot = self._slots[record["id"]] = len(self._slots)
+            if slot == len(self._rows):
+                self._rows = np.resize(self._rows, 2 * len(self._rows))
+        self._rows[slot] = (record["id"], record["x"], record["z"],
+                            TYPE_CODES.get(record["type"], UNKNOWN_CODE),
+                            STATE_CODES.get(record["state"], UNKNOWN_CODE), record["parked"], 0)
+
+    def _drop_row(self, vehicle_id):
+        """Quita la fila del vehículo moviendo la última a su lugar."""
+        self._frozen = None
+        slot = self._slots.pop(vehicle_id)
+        last = len(self._slots)
+        if slot != last:
+            self._rows[slot] = self._rows[last]
+            self._slots[int(self._rows[slot]["id"])] = slot
+
+
+feed = VehicleFeed()
+
+
+def take_snapshot(tick):
+    """
+    Construye un snapshot a partir del estado actual del modelo.
+    Sólo debe llamarse desde el hilo que avanza la simulación.
+    """
+    vehicles, removed, horizon, rows = feed.update(tick)
+    return Snapshot(tick, vehicles, tuple(get_lights_positions()), removed, horizon, rows)
+
+
+_ticker = None
+_ticker_lock = threading.Lock()
+
+
+# Segundos sin frames tras los que el stream manda un comentario keep-alive
+STREAM_KEEPALIVE = 15.0
+_encoded = {}  # formato -> (snapshot, bytes ya codificados)
+_encoded_lock = threading.Lock()
+
+
+def _encode_once(snapshot, kind, encoder):
+    """
+    Codifica un snapshot en un formato una sola vez y comparte el resultado
+    entre todas las peticiones que lean ese mismo snapshot.
+    """
+    with _encoded_lock:
+        cached, payload = _encoded.get(kind, (None, None))
+        if cached is not snapshot:
+            payload = encoder(snapshot)
+            _encoded[kind] = (snapshot, payload)
+        return payload
+
+
+def _sse_frame(snapshot):
+    data = json.dumps({"tick": snapshot.tick, "vehicles": snapshot.vehicles,
+                       "traffic_lights": snapshot.lights}, separators=(",", ":"))
+    return ("id: %d\nevent: frame\ndata: %s\n\n" % (snapshot.tick, data)).encode()
+
+
+def encode_frame(snapshot):
+    """
+    Codifica un snapshot como evento SSE con vehículos y semáforos del mismo tick.
+    """
+    return _encode_once(snapshot, "sse", _sse_frame)
+
+
+def _light_rows(snapshot):
+    lights = snapshot.lights
+    light_code = TYPE_CODES["TrafficLight"]
+    return np.fromiter(
+        ((l["id"], l["position"][0], l["position"][1], light_code,
+          STATE_CODES.get(l["state"], UNKNOWN_CODE), 0, 0) for l in lights),
+        dtype=RECORD_DTYPE, count=len(lights))
+
+
+def _binary_payload(snapshot, vehicles, lights):
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, RECORD_DTYPE.itemsize,
+                                snapshot.tick, len(vehicles), len(lights))
+    return header + vehicles.tobytes() + lights.tobytes()
+
+
+def encode_vehicles_binary(snapshot):
+    """
+    Snapshot completo de vehículos en formato binario (sin semáforos).
+    """
+    empty = np.empty(0, dtype=RECORD_DTYPE)
+    return _encode_once(snapshot, "vehicles-bin",
+                        lambda snap: _binary_payload(snap, snap.rows, empty))
+
+
+def encode_lights_binary(snapshot):
+    """
+    Semáforos del snapshot en formato binario (sin vehículos).
+    """
+    empty = np.empty(0, dtype=RECORD_DTYPE)
+    return _encode_once(snapshot, "lights-bin",
+                        lambda snap: _binary_payload(snap, empty, _light_rows(snap)))
+
+
+def wants_binary():
+    """
+    True si la petición pide el formato binario, por ?format=bin o por el
+    encabezado Accept. Ante un empate (p. ej. */*) se prefiere JSON.
+    """
+    if request.args.get("format") == "bin":
+        return True
+    best = request.accept_mimetypes.best_match(["application/json", BINARY_MIMETYPE])
+    return best == BINARY_MIMETYPE
+
+
+def _tick_loop():
+    """
+    Avanza la simulación a TICK_RATE pasos por segundo y publica un snapshot
+    tras cada paso. Es el único hilo que modifica el modelo.
+
+    Sigue avanzando aunque simulation.running sea False: el modelo solo lo
+    apaga cuando se estacionan los Ferrari, pero el resto de los vehículos y
+    los semáforos siguen en movimiento (igual que cuando cada /positions
+    avanzaba un paso). Si un paso falla se registra y se intenta el siguiente.
+    """
+    interval = 1.0 / TICK_RATE if TICK_RATE > 0 else 0.0
+    tick = 0
+    next_time = time.monotonic()
+    while True:
+        try:
+            simulation.step()
+            tick += 1
+            snapshots.publish(take_snapshot(tick))
+        except Exception:
+            app.logger.exception("Falló el paso %d de la simulación", tick + 1)
+        next_time += interval
+        delay = next_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_time = time.monotonic()  # Paso lento: no intentar recuperar el retraso
+
+
+def start_ticker():
+    """
+    Arranca el hilo de simulación una sola vez por proceso.
+    """
+    global _ticker
+    with _ticker_lock:
+        if _ticker is None:
+            _ticker = threading.Thread(target=_tick_loop, name="simulation-ticker", daemon=True)
+            _ticker.start()
+
+
+@app.before_request
+def _ensure_ticker():
+    start_ticker()
+
 @app.route("/")
 def index():
     return jsonify({"Message": "Bienvenido a la Simulación de Tráfico!"})
@@ -21,44 +337,81 @@ def index():
 def positions():
     """
     Endpoint para obtener las posiciones actuales de todos los vehículos.
+    Sirve el último snapshot publicado; la simulación avanza en su propio hilo.
+
+    Con ?since=<tick> sólo devuelve los vehículos que cambiaron después de
+    ese tick y los ids de los que desaparecieron. Si since es anterior al
+    historial conservado o posterior al tick actual (p. ej. el cliente lo
+    guardó antes de reiniciarse el servidor), responde el estado completo
+    con "full": true.
+
+    Con ?format=bin o Accept: application/octet-stream responde el estado
+    completo en el formato binario de registros fijos (since se ignora).
     """
-    simulation.step()  # Avanza un paso en la simulación
-    positions = get_vehicle_positions()
-    return jsonify({"vehicles": positions})
+    snapshot = snapshots.latest()
+    if wants_binary():
+        return Response(encode_vehicles_binary(snapshot), mimetype=BINARY_MIMETYPE)
+    since = request.args.get("since", type=int)
+    if since is None or since < snapshot.horizon or since > snapshot.tick:
+        return jsonify({"tick": snapshot.tick, "full": True, "vehicles": snapshot.vehicles})
+    changed, removed = snapshot.vehicles_since(since)
+    return jsonify({"tick": snapshot.tick, "since": since, "full": False,
+                    "vehicles": changed, "removed": removed})
 
 @app.route("/lights_positions", methods=['GET'])
 def lights_positions():
     """
     Endpoint para obtener las posiciones y estados de los semáforos.
+    Admite el mismo formato binario que /positions.
     """
-    lights = get_lights_positions()
-    return jsonify({"traffic_lights": lights})
+    snapshot = snapshots.latest()
+    if wants_binary():
+        return Response(encode_lights_binary(snapshot), mimetype=BINARY_MIMETYPE)
+    return jsonify({"tick": snapshot.tick, "traffic_lights": snapshot.lights})
 
-def get_vehicle_positions():
+@app.route("/map", methods=['GET'])
+def static_map():
     """
-    Obtiene las posiciones actuales de los vehículos en la simulación.
-    
-    Returns:
-        Listado de posiciones de vehículos como diccionarios.
-    """
-    vehicle_positions = []
-    for agent in simulation.schedule.agents:
-        if isinstance(agent, Vehicle):  # Verifica si el agente es un vehículo
-            x, z = agent.pos  # Obtiene la posición del vehículo
-            vehicle_positions.append({"x": x, "z": z})  # Agrega la posición a la lista
-        elif isinstance(agent, Microbus):  # Verifica si el agente es un microbús
-            x, z = agent.pos  # Obtiene la posición del vehículo
-            vehicle_positions.append({"x": x, "z": z})  # Agrega la posición a la lista
-        elif isinstance(agent, Jeeps):  # Verifica si el agente es un vehículo
-            x, z = agent.pos  # Obtiene la posición del vehículo
-            vehicle_positions.append({"x": x, "z": z})  # Agrega la posición a la lista
-        elif isinstance(agent, Toyota):  # Verifica si el agente es un vehículo
-            x, z = agent.pos  # Obtiene la posición del vehículo
-            vehicle_positions.append({"x": x, "z": z})  # Agrega la posición a la lista
-        elif isinstance(agent, Moto):  # Verifica si el agente es un vehículo
-            x, z = agent.pos  # Obtiene la posición del vehículo
-            vehicle_positions.append({"x": x, "z": z})  # Agrega la posición a la lista
-    return vehicle_positions
+    Endpoint con la capa estática del mapa: carriles, edificios,
+    estacionamientos, glorietas, paradas de microbús y semáforos. El cuerpo
+    se codifica una sola vez al arrancar; con If-None-Match y el ETag vigente
+    responde 304 sin cuerpo.
+    """
+    # Cada codificación es una representación distinta y lleva su propio ETag
+    if request.accept_encodings["gzip"] > 0:
+        body, etag, encoding = static_payload.compressed, static_payload.etag_gzip, "gzip"
+    else:
+        body, etag, encoding = static_payload.raw, static_payload.etag, None
+    headers = {"ETag": '"%s"' % etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    # Comparación débil: los proxies suelen reescribir el ETag como W/"..."
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(body, mimetype="application/json", headers=headers)
+
+@app.route("/stream", methods=['GET'])
+def stream():
+    """
+    Stream SSE con un frame combinado de vehículos y semáforos por tick.
+    Cada cliente recibe siempre el snapshot más reciente: si consume más
+    lento que la simulación, los frames intermedios se pierden en lugar de
+    acumularse.
+    """
+    def frames():
+        snapshot = snapshots.latest()
+        yield encode_frame(snapshot)
+        tick = snapshot.tick
+        while True:
+            snapshot = snapshots.wait_newer(tick, timeout=STREAM_KEEPALIVE)
+            if snapshot is None:
+                yield b": keep-alive\n\n"
+                continue
+            tick = snapshot.tick
+            yield encode_frame(snapshot)
+
+    return Response(frames(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 def get_lights_positions():
     """
@@ -69,17 +422,62 @@ def get_lights_positions():
         Listado de semáforos como diccionarios con posición, estado y ID.
     """
     semaforo_positions = []
-    for agent in simulation.schedule.agents:
-        if isinstance(agent, TrafficLight):  # Verifica si el agente es un semáforo
-            x, y = agent.pos  # Obtiene la posición del semáforo
-            state = agent.state if hasattr(agent, 'state') else "UNKNOWN"  # Estado actual
-            semaforo_positions.append({
-                "id": agent.unique_id,  # ID único del semáforo
-                "position": [x, y],  # Posición del semáforo
-                "state": state  # Estado actual (verde, rojo, amarillo)
-            })
+    for agent in simulation.lights:  # Registro de semáforos del modelo
+        x, y = agent.pos  # Obtiene la posición del semáforo
+        state = agent.state if hasattr(agent, 'state') else "UNKNOWN"  # Estado actual
+        semaforo_positions.append({
+            "id": agent.unique_id,  # ID único del semáforo
+            "position": [x, y],  # Posición del semáforo
+            "state": state  # Estado actual (verde, rojo, amarillo)
+        })
     return semaforo_positions
 
 
+class StaticPayload:
+    """
+    Capa estática del mapa ya codificada: JSON, su versión gzip y un ETag
+    derivado del contenido para cada una. Nada de esto cambia mientras corre
+    el servidor.
+    """
+    __slots__ = ("raw", "compressed", "etag", "etag_gzip")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.compressed = gzip.compress(raw, mtime=0)
+        self.etag = hashlib.sha256(raw).hexdigest()[:32]
+        self.etag_gzip = self.etag + "-gz"
+
+
+def encode_static_map():
+    """
+    Serializa la capa estática del modelo. Las posiciones van como listas
+    planas [x0, z0, x1, z1, ...] para que el cuerpo sea compacto.
+    """
+    layout = simulation.layout
+    static = {
+        "width": layout.width,
+        "height": layout.height,
+        "lanes": [
+            {"direction": lane.direction, "positions": lane.positions.ravel().tolist()}
+            for lane in layout.lanes
+        ],
+        "buildings": layout.buildings.ravel().tolist(),
+        "parkings": [coord for pos in layout.parkings for coord in pos],
+        "roundabouts": [coord for pos in layout.roundabouts for coord in pos],
+        "bus_stops": [coord for pos in layout.bus_stops for coord in pos],
+        "traffic_lights": [
+            {"id": light.unique_id, "position": list(light.pos)} for light in simulation.lights
+        ],
+    }
+    return StaticPayload(json.dumps(static, separators=(",", ":"), sort_keys=True).encode())
+
+
+# Snapshot inicial: los endpoints responden aun antes del primer paso
+snapshots = SnapshotBuffer(take_snapshot(0))
+static_payload = encode_static_map()
+
+
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=8000, debug=True)
\ No newline at end of file
+    start_ticker()
+    # Sin recargador: evita un segundo proceso con su propio hilo de simulación
+    app.run(host='0.0.0.0', port=8000, debug=True, use_reloader=False)
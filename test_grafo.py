@@ -0,0 +1,132 @@
+"""
+Pruebas de los planificadores del grafo de carriles contra el Dijkstra de referencia
+(RoadGraph.search), sobre una ciudad generada con obstáculos que cambian al azar.
+"""
+import random
+
+import numpy as np
+import pytest
+
+from Ciudad import generate_city
+from Grafo import DistanceFields, IncrementalPlanner, ObstacleLog, RoadGraph, SegmentGraph
+
+SIZE = 60
+
+
+@pytest.fixture(scope="module")
+def city():
+    layout = generate_city(SIZE, SIZE, seed=3)
+    graph = RoadGraph(layout.lanes)
+    cells = [graph.position(node) for node in range(len(graph))]
+    return layout, graph, cells
+
+
+@pytest.fixture
+def small_log(monkeypatch):
+    """Bitácora que se compacta seguido, para ejercitar a los lectores que se quedan atrás."""
+    monkeypatch.setattr(ObstacleLog, "COMPACT_AT", 8)
+    monkeypatch.setattr(ObstacleLog, "HISTORY", 24)
+    return ObstacleLog()
+
+
+def _toggle(rng, cells, mask, log, count, keep=()):
+    for _ in range(count):
+        cell = rng.choice(cells)
+        if cell in keep:
+            continue
+        mask[cell] = not mask[cell]
+        log.append(cell)
+
+
+def _is_walk(graph, path):
+    nodes = [graph.node(pos) for pos in path]
+    return all(b in {n for n, _ in graph.successors(a)} for a, b in zip(nodes, nodes[1:]))
+
+
+def test_incremental_planner_matches_search(city, small_log):
+    _, graph, cells = city
+    rng = random.Random(7)
+    for _ in range(40):
+        mask = np.zeros((SIZE, SIZE), dtype=bool)
+        log = small_log
+        goal = rng.choice(cells)
+        planner = IncrementalPlanner(graph, goal, mask, log)
+        start = rng.choice(cells)
+        for _ in range(20):
+            _toggle(rng, cells, mask, log, rng.choice([0, 1, 4, 30]), keep=(goal,))
+            if rng.random() < 0.5:
+                start = rng.choice(cells)
+            path = planner.plan(start)
+
+            distances, _ = graph.search(start, [goal], mask)
+            expected = distances.get(graph.node(goal))
+            if expected is None:
+                assert path == []
+                continue
+            assert len(path) - 1 == expected
+            assert path[0] == start and path[-1] == goal
+            assert _is_walk(graph, path)
+            assert not any(mask[cell] for cell in path[1:-1])
+
+
+def test_segment_graph_matches_search(city, small_log):
+    layout, graph, cells = city
+    segments = SegmentGraph(graph, layout.parkings)
+    reference = SegmentGraph(graph, layout.parkings)
+    mask = np.zeros((SIZE, SIZE), dtype=bool)
+    log = small_log
+    rng = random.Random(1)
+    for _ in range(150):
+        _toggle(rng, cells, mask, log, rng.choice([0, 1, 3, 40]))
+        # Las aristas bloqueadas llevadas con la bitácora coinciden con recalcularlas todas
+        assert set(segments._blocked_edges(mask, log)) == set(reference._blocked_edges(mask, None))
+
+        start = rng.choice(cells)
+        distances, previous = segments.search(start, layout.parkings, mask, log)
+        expected, _ = graph.search(start, layout.parkings, mask)
+        for key, distance in distances.items():
+            assert expected[key] == distance
+        for parking in layout.parkings:
+            node = graph.node(parking)
+            assert distances.get(node) == expected.get(node)
+            if node in distances:
+                route = list(segments.route(previous, node))
+                assert len(route) - 1 == distances[node]
+                assert route[0] == start and route[-1] == parking
+                assert _is_walk(graph, route)
+
+
+def test_batch_distances_match_search(city):
+    layout, graph, cells = city
+    rng = random.Random(5)
+    exempt = graph.nodes(layout.parkings)
+    for blocked in (None, np.random.default_rng(2).random((SIZE, SIZE)) < 0.05):
+        starts = [graph.node(cell) for cell in rng.sample(cells, 12)]
+        rows = graph.batch_distances(starts, blocked, exempt)
+        for start, row in zip(starts, rows):
+            expected, _ = graph.search(graph.position(start), layout.parkings, blocked)
+            reached = {node: int(row[node]) for node in np.flatnonzero(row >= 0).tolist()}
+            assert reached == expected
+
+
+def test_sparse_fields_match_dense(city, monkeypatch):
+    layout, graph, cells = city
+    dense = DistanceFields(graph, layout.parkings)
+    monkeypatch.setattr(DistanceFields, "DENSE_LIMIT", 0)
+    sparse = DistanceFields(graph, layout.parkings)
+    assert dense.dense and not sparse.dense
+
+    rng = random.Random(9)
+    for start in rng.sample(cells, 40):
+        candidates = rng.sample(layout.parkings, 5)
+        assert sparse.nearest(start, candidates) == dense.nearest(start, candidates)
+        for target in candidates:
+            distance = dense.distance(target, start)
+            assert sparse.distance(target, start) == distance
+            # Entre saltos igual de cortos cada modo puede elegir otro; basta que acerque un paso
+            hop = sparse.next_hop(target, start)
+            if hop is None or dense.next_hop(target, start) is None:
+                assert hop == dense.next_hop(target, start)
+            else:
+                assert graph.node(hop) in {node for node, _ in graph.successors(graph.node(start))}
+                assert dense.distance(target, hop) == distance - 1
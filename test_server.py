@@ -0,0 +1,72 @@
+"""
+Pruebas de los deltas de vehículos: aplicar vehicles_since sobre un snapshot anterior debe
+dar lo mismo que el snapshot completo, y las filas binarias deben coincidir con los registros.
+"""
+import random
+
+import pytest
+
+import server
+from Ferrari_model import TrafficSimulation
+
+
+@pytest.fixture
+def feed(monkeypatch):
+    random.seed(3)
+    simulation = TrafficSimulation(width=25, height=25, num_vehicles=6, num_microbus=3,
+                                   num_moto=3, num_jeeps=3, num_toyota=3)
+    monkeypatch.setattr(server, "simulation", simulation)
+    monkeypatch.setattr(server, "feed", server.VehicleFeed())
+    return simulation
+
+
+def _binary_rows(snapshot):
+    return {
+        int(row["id"]): (int(row["x"]), int(row["z"]), int(row["type"]), int(row["state"]), int(row["parked"]))
+        for row in snapshot.rows
+    }
+
+
+def _expected_rows(snapshot):
+    return {
+        record["id"]: (record["x"], record["z"], server.TYPE_CODES[record["type"]],
+                       server.STATE_CODES.get(record["state"], server.UNKNOWN_CODE), int(record["parked"]))
+        for record in snapshot.vehicles
+    }
+
+
+def test_deltas_rebuild_the_full_snapshot(feed):
+    simulation = feed
+    rng = random.Random(11)
+    snapshots = [server.take_snapshot(0)]
+    for tick in range(1, 90):
+        simulation.step()
+        if tick % 15 == 0:
+            # Un vehículo sale del registro del modelo: el feed debe reportarlo como baja
+            vehicles = next(group for group in simulation.vehicles.values() if group)
+            vehicles.pop(rng.randrange(len(vehicles)))
+        snapshot = server.take_snapshot(tick)
+        snapshots.append(snapshot)
+
+        full = {record["id"]: record for record in snapshot.vehicles}
+        assert [record["changed_at"] for record in snapshot.vehicles] == sorted(
+            record["changed_at"] for record in snapshot.vehicles)
+        assert _binary_rows(snapshot) == _expected_rows(snapshot)
+
+        for since in {rng.randrange(snapshot.horizon, tick + 1) for _ in range(5)}:
+            state = {record["id"]: record for record in snapshots[since].vehicles}
+            changed, removed = snapshot.vehicles_since(since)
+            for vehicle_id in removed:
+                state.pop(vehicle_id, None)
+            state.update((record["id"], record) for record in changed)
+            assert state == full
+
+
+def test_binary_payload_uses_snapshot_rows(feed):
+    feed.step()
+    snapshot = server.take_snapshot(1)
+    payload = server.encode_vehicles_binary(snapshot)
+    header = server.BINARY_HEADER.unpack_from(payload)
+    assert header == (server.BINARY_MAGIC, server.BINARY_VERSION, server.RECORD_DTYPE.itemsize,
+                      1, len(snapshot.vehicles), 0)
+    assert payload[server.BINARY_HEADER.size:] == snapshot.rows.tobytes()